@@ -1,87 +1,64 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+import time
+
+_import_started = time.perf_counter()
+
+from flask import Flask, Blueprint, current_app, request, stream_with_context, jsonify, render_template, session, redirect, url_for
 from flask_cors import CORS
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 import os
-import certifi
-
-from groq import Groq
-import PyPDF2
-from PIL import Image
-import pytesseract
-import io
-import base64
+from functools import wraps
+import shutil
+import tempfile
+import threading
+import zipfile
+
 from werkzeug.utils import secure_filename
-from fun import count_tokens
-from pymongo import MongoClient
 from datetime import datetime, timedelta
 import uuid
-from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
-import razorpay
 import hmac
+import json
 import hashlib
 
-# Load environment variables
+# Load environment variables (before the modules below read their settings)
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-change-this")
-CORS(app, supports_credentials=True)
+from database import get_mongo_client, users_collection, chats_collection, reports_collection, subscriptions_collection
+from fun import count_tokens_simple
+from extraction import MAX_BATCH_FILES, allowed_file, extract_pages, expand_zip, extract_pages_concurrently, merge_report_texts, preflight
+from llm import get_groq_client, classify_chat_request, create_completion, generate_report_explanation
+from cache import cache
+from compression import conditional, init_compression
+from export import EXPORT_FORMATS
+from idempotency import idempotent
+import profiling
+from normalize import normalize_pages, normalize_text
+from pipeline import run_pipeline
+from retention import NOT_DELETED, init_retention, soft_delete_chat
+from summaries import build_history_messages, schedule_summary_update
+import traffic
+
+bp = Blueprint('main', __name__)
 
 # Flask-Login Configuration
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# OAuth Configuration (Google Login) - FIXED VERSION
-oauth = OAuth(app)
-
-google = oauth.register(
-    name='google',
-    client_id=os.environ.get("GOOGLE_CLIENT_ID"),
-    client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={'scope': 'openid email profile'},
-)
-
-# Razorpay Configuration
-razorpay_client = razorpay.Client(
-    auth=(os.environ.get("RAZORPAY_KEY_ID", ""), os.environ.get("RAZORPAY_KEY_SECRET", ""))
-)
+login_manager.login_view = 'main.login'
 
 # Configure upload folder
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
-
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-
-# MongoDB Configuration
-# MongoDB Configuration (Render-safe)
 
-MONGO_URI = os.getenv("MONGO_URI")
+# Comma-separated emails allowed to use /api/admin/* endpoints
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get("ADMIN_EMAILS", "").split(',') if e.strip()}
 
-mongo_client = MongoClient(
-    MONGO_URI,
-    serverSelectionTimeoutMS=10000,
-    connectTimeoutMS=10000
-)
-
-db = mongo_client["medical_db"]
-
-users_collection = db["users"]
-chats_collection = db["chats"]
-reports_collection = db["reports"]
-subscriptions_collection = db["subscriptions"]
+_import_seconds = time.perf_counter() - _import_started
 
 # Subscription Plans
 PLANS = {
     'free': {
         'name': 'Free Plan',
         'questions_per_chat': 5,
+        'max_pages': 10,  # pages analyzed per report
+        'max_pixels': 25_000_000,  # largest page image, in pixels
         'price': 0,
         'discount': 0,
         'tag': 'Basic'
@@ -89,6 +66,8 @@ PLANS = {
     'starter': {
         'name': 'Starter Plan',
         'questions_per_chat': 10,
+        'max_pages': 25,
+        'max_pixels': 40_000_000,
         'price': 49,
         'duration_days': 30,
         'discount': 0,
@@ -98,6 +77,8 @@ PLANS = {
     'pro': {
         'name': 'Pro Plan',
         'questions_per_chat': 22,
+        'max_pages': 50,
+        'max_pixels': 60_000_000,
         'price': 89,
         'duration_days': 30,
         'discount': 51,
@@ -107,6 +88,8 @@ PLANS = {
     'unlimited': {
         'name': 'Unlimited Plan',
         'questions_per_chat': -1,  # -1 means unlimited
+        'max_pages': 100,
+        'max_pixels': 80_000_000,
         'price': 999,
         'duration_days': 365,  # 1 year
         'discount': 92,
@@ -125,25 +108,40 @@ class User(UserMixin):
         self.subscription_plan = user_data.get('subscription_plan', 'free')
         self.subscription_expires = user_data.get('subscription_expires')
 
+def get_user_data(user_id):
+    """Get the user's profile and plan, through the shared cache"""
+    from bson.objectid import ObjectId
+    
+    def fetch():
+        user = users_collection.find_one({'_id': ObjectId(user_id)})
+        if not user:
+            return None
+        expires = user.get('subscription_expires')
+        return {
+            '_id': user_id,
+            'email': user['email'],
+            'name': user.get('name', ''),
+            'picture': user.get('picture', ''),
+            'subscription_plan': user.get('subscription_plan', 'free'),
+            'subscription_expires': expires.isoformat() if expires else None
+        }
+    
+    user = cache.get_or_set('user', user_id, fetch)
+    if user and user['subscription_expires']:
+        user = dict(user, subscription_expires=datetime.fromisoformat(user['subscription_expires']))
+    return user
+
 @login_manager.user_loader
 def load_user(user_id):
-    from bson.objectid import ObjectId
-    user_data = users_collection.find_one({'_id': ObjectId(user_id)})
+    user_data = get_user_data(user_id)
     if user_data:
         return User(user_data)
     return None
 
-# Initialize Groq client
-def get_groq_client():
-    api_key = os.environ.get("GROQ_API_KEY")
-    if not api_key:
-        raise ValueError("GROQ_API_KEY environment variable not set")
-    return Groq(api_key=api_key)
-
 def get_user_subscription(user_id):
     """Get user's current subscription plan"""
     from bson.objectid import ObjectId
-    user = users_collection.find_one({'_id': ObjectId(user_id)})
+    user = get_user_data(user_id)
     
     if not user:
         return PLANS['free']
@@ -158,6 +156,7 @@ def get_user_subscription(user_id):
             {'_id': ObjectId(user_id)},
             {'$set': {'subscription_plan': 'free', 'subscription_expires': None}}
         )
+        cache.delete('user', user_id)
         return PLANS['free']
     
     return PLANS.get(plan, PLANS['free'])
@@ -166,7 +165,8 @@ def count_chat_questions(chat_id):
     """Count questions in current chat session"""
     count = chats_collection.count_documents({
         'chat_id': chat_id,
-        'role': 'user'
+        'role': 'user',
+        **NOT_DELETED
     })
     return count
 
@@ -201,10 +201,16 @@ def save_chat_message(user_id, chat_id, role, content, report_id=None):
     
     chats_collection.insert_one(chat_data)
 
+def describe_page_budget(total_pages, processed_pages):
+    """Tell the user which pages were analyzed when the plan's page budget cut a report short"""
+    if processed_pages >= total_pages:
+        return ''
+    return f' Only the first {processed_pages} of {total_pages} pages were analyzed (your plan\'s limit) - upgrade to analyze longer reports.'
+
 def get_chat_history(user_id, chat_id, limit=50):
     """Get chat history for specific chat"""
     chats = chats_collection.find(
-        {'user_id': user_id, 'chat_id': chat_id}
+        {'user_id': user_id, 'chat_id': chat_id, **NOT_DELETED}
     ).sort('timestamp', 1).limit(limit)
     
     history = []
@@ -220,7 +226,7 @@ def get_chat_history(user_id, chat_id, limit=50):
 def get_all_chats(user_id):
     """Get all chat sessions for user"""
     pipeline = [
-        {'$match': {'user_id': user_id}},
+        {'$match': {'user_id': user_id, **NOT_DELETED}},
         {'$group': {
             '_id': '$chat_id',
             'last_message': {'$last': '$content'},
@@ -236,7 +242,7 @@ def get_all_chats(user_id):
     for chat in chats:
         # Get first user message as title
         first_message = chats_collection.find_one(
-            {'chat_id': chat['_id'], 'role': 'user'},
+            {'chat_id': chat['_id'], 'role': 'user', **NOT_DELETED},
             sort=[('timestamp', 1)]
         )
         
@@ -252,57 +258,94 @@ def get_all_chats(user_id):
     
     return result
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+_razorpay_client = None
+_razorpay_client_pid = None
 
-def extract_text_from_pdf(file_path):
-    """Extract text from PDF file"""
-    try:
-        text = ""
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text.strip()
-    except Exception as e:
-        return f"Error extracting PDF: {str(e)}"
+def get_razorpay_client():
+    """Get the Razorpay client for the current process, importing razorpay on first use"""
+    global _razorpay_client, _razorpay_client_pid
+    
+    if _razorpay_client is None or _razorpay_client_pid != os.getpid():
+        import razorpay
+        _razorpay_client = razorpay.Client(
+            auth=(os.environ.get("RAZORPAY_KEY_ID", ""), os.environ.get("RAZORPAY_KEY_SECRET", ""))
+        )
+        _razorpay_client_pid = os.getpid()
+    
+    return _razorpay_client
 
-def extract_text_from_image(file_path):
-    """Extract text from image using OCR"""
-    try:
-        image = Image.open(file_path)
-        text = pytesseract.image_to_string(image)
-        return text.strip()
-    except Exception as e:
-        return f"Error extracting from image: {str(e)}"
+_startup_report = None
+_startup_report_pid = None
+_startup_report_lock = threading.Lock()
+
+def ensure_startup_report():
+    """before_request hook - build and print this worker's startup report after fork"""
+    global _startup_report, _startup_report_pid
+    
+    if _startup_report_pid == os.getpid():
+        return
+    
+    with _startup_report_lock:
+        if _startup_report_pid == os.getpid():
+            return
+        
+        # With --preload the app was built once in the gunicorn master, before fork
+        build = current_app.config['APP_BUILD_REPORT']
+        _startup_report = {
+            'pid': os.getpid(),
+            'app_built_in_pid': build['pid'],
+            'preloaded': build['pid'] != os.getpid(),
+            'imports_ms': build['imports_ms'],
+            'oauth_ms': build['oauth_ms'],
+            'create_app_ms': build['create_app_ms']
+        }
+        _startup_report_pid = os.getpid()
+        print(f"Startup report: {_startup_report}")
+
+def get_startup_report():
+    """Startup report of the current worker process"""
+    return _startup_report if _startup_report_pid == os.getpid() else None
+
+def admin_required(view):
+    """Allow only logged-in users listed in ADMIN_EMAILS"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated or current_user.email.lower() not in ADMIN_EMAILS:
+            return jsonify({'error': 'Admin access required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def get_google_oauth():
+    """Get the Google OAuth client registered by create_app()"""
+    return current_app.extensions['google_oauth']
 
 # Routes
-@app.route('/')
+@bp.route('/')
 def index():
     if current_user.is_authenticated:
         return render_template('index.html')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/login')
+@bp.route('/login')
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     return render_template('login.html')
 
-@app.route('/login/google')
+@bp.route('/login/google')
 def google_login():
-    redirect_uri = url_for('google_authorize', _external=True)
-    return google.authorize_redirect(redirect_uri)
+    redirect_uri = url_for('main.google_authorize', _external=True)
+    return get_google_oauth().authorize_redirect(redirect_uri)
 
-@app.route('/login/google/authorize')
+@bp.route('/login/google/authorize')
 def google_authorize():
     try:
-        token = google.authorize_access_token()
+        token = get_google_oauth().authorize_access_token()
         user_info = token.get('userinfo')
         
         if not user_info:
             print("No user info received from Google")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         
         # Check if user exists
         user_data = users_collection.find_one({'email': user_info['email']})
@@ -332,22 +375,23 @@ def google_authorize():
         login_user(user)
         
         print(f"User logged in successfully: {user_info['email']}")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
         
     except Exception as e:
         print(f"Login error: {str(e)}")
         import traceback
         traceback.print_exc()
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/api/user/info', methods=['GET'])
+@bp.route('/api/user/info', methods=['GET'])
 @login_required
+@conditional
 def user_info():
     """Get current user information"""
     subscription = get_user_subscription(current_user.id)
@@ -364,8 +408,29 @@ def user_info():
         }
     })
 
-@app.route('/api/analyze', methods=['POST'])
+@bp.route('/api/user/export', methods=['GET'])
+@login_required
+def export_user_data():
+    """Stream all of the current user's chats and reports as NDJSON or ZIP"""
+    from bson.objectid import ObjectId
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': 'Invalid export format. Use ndjson or zip.'}), 400
+    
+    user = users_collection.find_one({'_id': ObjectId(current_user.id)})
+    generate, mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f"medical-report-analyzer-export-{datetime.utcnow().strftime('%Y%m%d')}.{extension}"
+    
+    return current_app.response_class(
+        stream_with_context(generate(user)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@bp.route('/api/analyze', methods=['POST'])
 @login_required
+@idempotent
 def analyze_report():
     try:
         # Check if file is present
@@ -384,19 +449,29 @@ def analyze_report():
         
         # Save file temporarily
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
         
-        # Extract text based on file type
+        # Reject undecodable or oversized files and bound the pages before any OCR runs
         file_ext = filename.rsplit('.', 1)[1].lower()
-        if file_ext == 'pdf':
-            extracted_text = extract_text_from_pdf(file_path)
-        else:
-            extracted_text = extract_text_from_image(file_path)
+        subscription = get_user_subscription(current_user.id)
+        try:
+            budget = preflight(file_path, file_ext, subscription['max_pages'], subscription['max_pixels'])
+        except ValueError as e:
+            os.remove(file_path)
+            return jsonify({'error': str(e)}), 400
+        
+        # Extract text based on file type
+        pages = extract_pages(file_path, file_ext, budget['processed_pages'])
         
         # Clean up uploaded file
         os.remove(file_path)
         
+        # Drop repeated headers/footers, boilerplate and OCR noise once, before storing
+        extracted_text, normalization = normalize_text(pages)
+        print(f"Normalized {filename}: {normalization['tokens_before']} -> {normalization['tokens_after']} tokens ({normalization['tokens_saved_pct']}% saved)")
+        traffic.annotate(chat_id=chat_id, pages=budget['processed_pages'], report_tokens=normalization['tokens_after'])
+        
         if not extracted_text or len(extracted_text) < 10:
             return jsonify({'error': 'Could not extract meaningful text from the file. Please ensure the file is clear and readable.'}), 400
         
@@ -405,6 +480,9 @@ def analyze_report():
             'user_id': current_user.id,
             'filename': filename,
             'extracted_text': extracted_text,
+            'normalization': normalization,
+            'total_pages': budget['total_pages'],
+            'processed_pages': budget['processed_pages'],
             'uploaded_at': datetime.utcnow()
         }
         result = reports_collection.insert_one(report_data)
@@ -436,99 +514,264 @@ def analyze_report():
             'extracted_text': extracted_text,
             'chat_id': chat_id,
             'report_id': report_id,
-            'message': 'Report analyzed successfully. You can now ask questions about it.',
-            'auto_explanation': auto_explanation
+            'message': 'Report analyzed successfully. You can now ask questions about it.' + describe_page_budget(budget['total_pages'], budget['processed_pages']),
+            'auto_explanation': auto_explanation,
+            'normalization': normalization,
+            'total_pages': budget['total_pages'],
+            'processed_pages': budget['processed_pages'],
+            'truncated': budget['truncated']
         })
         
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-def generate_report_explanation(report_text, language='english'):
-    """Generate automatic report explanation in selected language"""
+@bp.route('/api/analyze/batch', methods=['POST'])
+@login_required
+@idempotent
+def analyze_report_batch():
+    """Analyze several files (or a ZIP of files) as one combined report"""
+    upload_dir = None
     try:
-        client = get_groq_client()
-        
-        # Language-specific prompts
-        language_prompts = {
-            'hindi': """कृपया इस मेडिकल रिपोर्ट का पूर्ण विश्लेषण हिंदी में प्रदान करें। निम्नलिखित बिंदुओं को कवर करें:
-
-1. **रिपोर्ट का सारांश**: यह रिपोर्ट किस बारे में है?
-2. **महत्वपूर्ण निष्कर्ष**: रिपोर्ट में क्या पाया गया?
-3. **असामान्य मान**: कौन से टेस्ट परिणाम सामान्य सीमा से बाहर हैं?
-4. **सामान्य भाषा में स्पष्टीकरण**: मेडिकल शब्दों को सरल हिंदी में समझाएं
-5. **सुझाव**: क्या कोई सावधानियां या अगले कदम हैं?
-
-कृपया सरल और समझने योग्य हिंदी में जवाब दें। हमेशा डॉक्टर से परामर्श की सलाह दें।""",
-            
-            'english': """Please provide a complete analysis of this medical report in English. Cover the following points:
-
-1. **Report Summary**: What is this report about?
-2. **Key Findings**: What was found in the report?
-3. **Abnormal Values**: Which test results are outside normal range?
-4. **Plain Language Explanation**: Explain medical terms in simple English
-5. **Recommendations**: Any precautions or next steps?
-
-Please respond in simple and understandable English. Always recommend consulting a doctor.""",
+        files = [f for f in request.files.getlist('files') if f.filename]
+        chat_id = request.form.get('chat_id', str(uuid.uuid4()))
+        selected_language = request.form.get('language', 'english')
+        
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+        
+        for file in files:
+            if not (allowed_file(file.filename) or file.filename.lower().endswith('.zip')):
+                return jsonify({'error': f'Invalid file type: {file.filename}. Please upload PDF, image or ZIP files.'}), 400
+        
+        # Save every upload into its own temporary folder
+        upload_dir = tempfile.mkdtemp(dir=current_app.config['UPLOAD_FOLDER'])
+        named_paths = []
+        for index, file in enumerate(files):
+            file_ext = file.filename.rsplit('.', 1)[1].lower()
+            file_path = os.path.join(upload_dir, f"upload_{index}.{file_ext}")
+            file.save(file_path)
             
-            'gujarati': """કૃપા કરીને આ મેડિકલ રિપોર્ટનું સંપૂર્ણ વિશ્લેષણ ગુજરાતીમાં પ્રદાન કરો. નીચેના મુદ્દાઓને આવરી લો:
-
-1. **રિપોર્ટનો સારાંશ**: આ રિપોર્ટ શેના વિશે છે?
-2. **મહત્વના તારણો**: રિપોર્ટમાં શું મળ્યું?
-3. **અસામાન્ય મૂલ્યો**: કયા ટેસ્ટ પરિણામો સામાન્ય મર્યાદાની બહાર છે?
-4. **સરળ ભાષામાં સમજૂતી**: મેડિકલ શબ્દોને સરળ ગુજરાતીમાં સમજાવો
-5. **ભલામણો**: કોઈ સાવધાનીઓ અથવા આગળના પગલાં?
-
-કૃપા કરીને સરળ અને સમજી શકાય તેવા ગુજરાતીમાં જવાબ આપો. હંમેશા ડૉક્ટર સાથે પરામર્શ કરવાની સલાહ આપો."""
-        }
+            if file_ext == 'zip':
+                try:
+                    named_paths.extend(expand_zip(file_path, upload_dir))
+                except (ValueError, zipfile.BadZipFile) as e:
+                    return jsonify({'error': f'Invalid ZIP file {file.filename}: {str(e)}'}), 400
+            else:
+                named_paths.append((secure_filename(file.filename), file_path))
         
-        # Get the appropriate prompt
-        language_prompt = language_prompts.get(language, language_prompts['english'])
-        
-        # Create message for AI
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a helpful medical assistant AI. Provide clear, comprehensive medical report analysis.
-Be empathetic, explain medical terms simply, and always recommend consulting a doctor for specific medical advice."""
-            },
-            {
-                "role": "user",
-                "content": f"{language_prompt}\n\nMedical Report Content:\n\n{report_text}"
-            }
-        ]
+        if not named_paths:
+            return jsonify({'error': 'No PDF or image files found in the upload'}), 400
         
-        # Calculate tokens
-        prompt_tokens = count_tokens(messages)
-        context_window = 131072
-        max_output_tokens = 32768
-        safety_buffer = 1000
+        if len(named_paths) > MAX_BATCH_FILES:
+            return jsonify({'error': f'Please upload at most {MAX_BATCH_FILES} files at once'}), 400
         
-        max_allowed_output = min(
-            max_output_tokens,
-            context_window - prompt_tokens - safety_buffer
+        # Pre-flight every file; the plan's page budget covers all files together, in upload order
+        subscription = get_user_subscription(current_user.id)
+        remaining_pages = subscription['max_pages']
+        total_pages = 0
+        budgeted = []
+        failed = []
+        skipped = []
+        for filename, path in named_paths:
+            try:
+                budget = preflight(path, path.rsplit('.', 1)[1].lower(), remaining_pages, subscription['max_pixels'])
+            except ValueError as e:
+                failed.append(filename)
+                print(f"Pre-flight rejected {filename}: {str(e)}")
+                continue
+            
+            total_pages += budget['total_pages']
+            if remaining_pages <= 0:
+                skipped.append(filename)
+                continue
+            budgeted.append((filename, path, budget['processed_pages']))
+            remaining_pages -= budget['processed_pages']
+        
+        if not budgeted:
+            return jsonify({'error': 'None of the files could be read. Please upload clear, unencrypted PDF or image files.'}), 400
+        
+        # Extract all files concurrently, keeping upload order
+        page_lists = extract_pages_concurrently(
+            [path for _, path, _ in budgeted],
+            page_limits=[max_pages for _, _, max_pages in budgeted]
         )
         
-        if max_allowed_output < 100:
-            return None
+        processed = []
+        for (filename, _, _), pages in zip(budgeted, page_lists):
+            text = "\n".join(pages).strip()
+            if not text or len(text) < 10 or text.startswith('Error extracting'):
+                failed.append(filename)
+            else:
+                processed.append((filename, pages))
+        
+        if not processed:
+            return jsonify({'error': 'Could not extract meaningful text from the files. Please ensure the files are clear and readable.'}), 400
+        
+        # Normalize all pages together, so a letterhead shared by every file is kept only once
+        normalized, normalization = normalize_pages([page for _, pages in processed for page in pages])
+        print(f"Normalized {len(processed)} files: {normalization['tokens_before']} -> {normalization['tokens_after']} tokens ({normalization['tokens_saved_pct']}% saved)")
+        
+        named_texts = []
+        offset = 0
+        for filename, pages in processed:
+            file_pages = normalized[offset:offset + len(pages)]
+            offset += len(pages)
+            named_texts.append((filename, "\n\n".join(page for page in file_pages if page)))
+        
+        extracted_text = merge_report_texts(named_texts)
+        filenames = [filename for filename, _ in processed]
+        processed_pages = sum(max_pages for _, _, max_pages in budgeted)
+        traffic.annotate(chat_id=chat_id, files=len(filenames), pages=processed_pages, report_tokens=normalization['tokens_after'])
+        
+        # Save combined report to database
+        report_data = {
+            'user_id': current_user.id,
+            'filename': ', '.join(filenames),
+            'filenames': filenames,
+            'extracted_text': extracted_text,
+            'normalization': normalization,
+            'total_pages': total_pages,
+            'processed_pages': processed_pages,
+            'uploaded_at': datetime.utcnow()
+        }
+        result = reports_collection.insert_one(report_data)
+        report_id = str(result.inserted_id)
         
-        # Get response from Groq
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.3,
-            max_tokens=max_allowed_output,
-            top_p=0.9
+        save_chat_message(
+            current_user.id,
+            chat_id,
+            'system',
+            f'Files uploaded: {", ".join(filenames)}',
+            report_id=report_id
         )
         
-        explanation = chat_completion.choices[0].message.content
-        return explanation
+        # One explanation for the whole combined report
+        auto_explanation = generate_report_explanation(extracted_text, selected_language)
+        
+        if auto_explanation:
+            save_chat_message(
+                current_user.id,
+                chat_id,
+                'assistant',
+                auto_explanation
+            )
+        
+        return jsonify({
+            'success': True,
+            'extracted_text': extracted_text,
+            'chat_id': chat_id,
+            'report_id': report_id,
+            'files_processed': filenames,
+            'files_failed': failed,
+            'files_skipped': skipped,
+            'message': f'{len(filenames)} files analyzed successfully. You can now ask questions about them.' + describe_page_budget(total_pages, processed_pages),
+            'auto_explanation': auto_explanation,
+            'normalization': normalization,
+            'total_pages': total_pages,
+            'processed_pages': processed_pages,
+            'truncated': processed_pages < total_pages
+        })
         
     except Exception as e:
-        print(f"Error generating explanation: {str(e)}")
-        return None
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+@bp.route('/api/analyze/stream', methods=['POST'])
+@login_required
+@idempotent
+def analyze_report_stream():
+    """Analyze one report, streaming pages and the explanation as NDJSON events while OCR runs"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    
+    file = request.files['file']
+    chat_id = request.form.get('chat_id', str(uuid.uuid4()))
+    selected_language = request.form.get('language', 'english')
+    
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if not allowed_file(file.filename):
+        return jsonify({'error': 'Invalid file type. Please upload PDF or image files.'}), 400
+    
+    filename = secure_filename(file.filename)
+    file_ext = file.filename.rsplit('.', 1)[1].lower()
+    fd, file_path = tempfile.mkstemp(suffix=f'.{file_ext}', dir=current_app.config['UPLOAD_FOLDER'])
+    os.close(fd)
+    file.save(file_path)
+    user_id = current_user.id
+    
+    # Reject before the stream starts, so clients get a normal JSON error
+    subscription = get_user_subscription(user_id)
+    try:
+        budget = preflight(file_path, file_ext, subscription['max_pages'], subscription['max_pixels'])
+    except ValueError as e:
+        os.remove(file_path)
+        return jsonify({'error': str(e)}), 400
+    
+    page_info = {
+        'total_pages': budget['total_pages'],
+        'processed_pages': budget['processed_pages'],
+        'truncated': budget['truncated']
+    }
+    
+    def generate():
+        try:
+            for event in run_pipeline(file_path, file_ext, selected_language, budget['processed_pages']):
+                if event['type'] == 'start':
+                    event.update(page_info, chat_id=chat_id)
+                
+                elif event['type'] == 'result':
+                    normalization = event['normalization']
+                    print(f"Normalized {filename}: {normalization['tokens_before']} -> {normalization['tokens_after']} tokens ({normalization['tokens_saved_pct']}% saved)")
+                    traffic.annotate(chat_id=chat_id, pages=budget['processed_pages'], report_tokens=normalization['tokens_after'])
+                    
+                    result = reports_collection.insert_one({
+                        'user_id': user_id,
+                        'filename': filename,
+                        'extracted_text': event['extracted_text'],
+                        'normalization': normalization,
+                        'total_pages': budget['total_pages'],
+                        'processed_pages': budget['processed_pages'],
+                        'uploaded_at': datetime.utcnow()
+                    })
+                    report_id = str(result.inserted_id)
+                    
+                    save_chat_message(user_id, chat_id, 'system', f'File uploaded: {filename}', report_id=report_id)
+                    if event['explanation']:
+                        save_chat_message(user_id, chat_id, 'assistant', event['explanation'])
+                    
+                    event = {
+                        'type': 'done',
+                        'success': True,
+                        'chat_id': chat_id,
+                        'report_id': report_id,
+                        'extracted_text': event['extracted_text'],
+                        'message': 'Report analyzed successfully. You can now ask questions about it.' + describe_page_budget(budget['total_pages'], budget['processed_pages']),
+                        'explanation_pages': event['explanation_pages'],
+                        'normalization': normalization,
+                        **page_info
+                    }
+                
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': f'Server error: {str(e)}'}) + "\n"
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+    
+    # X-Accel-Buffering stops nginx from holding events back until the end
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+    )
 
-@app.route('/api/chat', methods=['POST'])
+@bp.route('/api/chat', methods=['POST'])
 @login_required
+@idempotent
 def chat():
     try:
         data = request.json
@@ -559,8 +802,8 @@ def chat():
         # Initialize Groq client
         client = get_groq_client()
         
-        # Get chat history from database
-        db_history = get_chat_history(current_user.id, chat_id, limit=50)
+        # Get summary + recent turns from database
+        history_messages = build_history_messages(current_user.id, chat_id)
         
         # Build conversation context
         messages = [
@@ -620,44 +863,32 @@ IMPORTANT: You can answer questions even without a medical report. Provide helpf
                 "content": f"Medical Report Content:\n\n{report_text}"
             })
         
-        # Add chat history from database (last 10 messages for context)
-        for msg in db_history[-10:]:
-            if msg['role'] != 'system':
-                messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
-        
-        # Calculate tokens and respect Groq's limits
-        prompt_tokens = count_tokens(messages)
-        context_window = 131072
-        max_output_tokens = 32768
-        safety_buffer = 1000
-        
-        max_allowed_output = min(
-            max_output_tokens,
-            context_window - prompt_tokens - safety_buffer
-        )
+        # Add rolling summary of older turns and the recent turns verbatim
+        messages.extend(history_messages)
+        
+        if traffic.is_recording():
+            traffic.annotate(
+                chat_id=chat_id,
+                message_tokens=count_tokens_simple(user_message),
+                report_tokens=count_tokens_simple(report_text) if report_text else 0,
+                history_messages=len(history_messages)
+            )
         
-        if max_allowed_output < 100:
+        # Route short / follow-up questions to the fast model
+        request_type = classify_chat_request(user_message, report_text, history_messages[:-1])
+        assistant_response, _ = create_completion(client, messages, request_type)
+        
+        if assistant_response is None:
             return jsonify({
                 'error': 'The report is too long. Please try a shorter report or ask a specific question.'
             }), 400
         
-        # Get response from Groq
-        chat_completion = client.chat.completions.create(
-            messages=messages,
-            model="llama-3.3-70b-versatile",
-            temperature=0.3,
-            max_tokens=max_allowed_output,
-            top_p=0.9
-        )
-        
-        assistant_response = chat_completion.choices[0].message.content
-        
         # Save assistant response
         save_chat_message(current_user.id, chat_id, 'assistant', assistant_response)
         
+        # Fold older turns into the chat summary in the background
+        schedule_summary_update(current_user.id, chat_id)
+        
         # Get updated question count
         question_count = count_chat_questions(chat_id)
         
@@ -673,21 +904,28 @@ IMPORTANT: You can answer questions even without a medical report. Provide helpf
     except Exception as e:
         return jsonify({'error': f'Chat error: {str(e)}'}), 500
 
-@app.route('/api/chats', methods=['GET'])
+@bp.route('/api/chats', methods=['GET'])
 @login_required
+@conditional
 def get_chats():
     """Get all chat sessions for current user"""
     try:
         chats = get_all_chats(current_user.id)
-        return jsonify({
+        response = jsonify({
             'success': True,
             'chats': chats
         })
+        
+        # Chats are sorted newest first
+        if chats:
+            response.last_modified = datetime.fromisoformat(chats[0]['last_timestamp'])
+        return response
     except Exception as e:
         return jsonify({'error': f'Error fetching chats: {str(e)}'}), 500
 
-@app.route('/api/chat/<chat_id>', methods=['GET'])
+@bp.route('/api/chat/<chat_id>', methods=['GET'])
 @login_required
+@conditional
 def get_chat(chat_id):
     """Get specific chat history"""
     try:
@@ -695,7 +933,7 @@ def get_chat(chat_id):
         subscription = get_user_subscription(current_user.id)
         question_count = count_chat_questions(chat_id)
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'history': history,
             'chat_id': chat_id,
@@ -703,18 +941,19 @@ def get_chat(chat_id):
             'questions_limit': subscription['questions_per_chat'],
             'plan_name': subscription['name']
         })
+        
+        if history:
+            response.last_modified = datetime.fromisoformat(history[-1]['timestamp'])
+        return response
     except Exception as e:
         return jsonify({'error': f'Error fetching chat: {str(e)}'}), 500
 
-@app.route('/api/chat/<chat_id>', methods=['DELETE'])
+@bp.route('/api/chat/<chat_id>', methods=['DELETE'])
 @login_required
 def delete_chat(chat_id):
-    """Delete specific chat"""
+    """Delete specific chat (soft delete - the retention TTL index removes it later)"""
     try:
-        chats_collection.delete_many({
-            'user_id': current_user.id,
-            'chat_id': chat_id
-        })
+        soft_delete_chat(current_user.id, chat_id)
         
         return jsonify({
             'success': True,
@@ -723,7 +962,8 @@ def delete_chat(chat_id):
     except Exception as e:
         return jsonify({'error': f'Error deleting chat: {str(e)}'}), 500
 
-@app.route('/api/subscription/plans', methods=['GET'])
+@bp.route('/api/subscription/plans', methods=['GET'])
+@conditional
 def get_plans():
     """Get all subscription plans"""
     return jsonify({
@@ -731,7 +971,7 @@ def get_plans():
         'plans': PLANS
     })
 
-@app.route('/api/subscription/create-order', methods=['POST'])
+@bp.route('/api/subscription/create-order', methods=['POST'])
 @login_required
 def create_subscription_order():
     """Create Razorpay order for subscription"""
@@ -756,7 +996,7 @@ def create_subscription_order():
             }
         }
         
-        order = razorpay_client.order.create(data=order_data)
+        order = get_razorpay_client().order.create(data=order_data)
         
         return jsonify({
             'success': True,
@@ -769,7 +1009,7 @@ def create_subscription_order():
     except Exception as e:
         return jsonify({'error': f'Order creation failed: {str(e)}'}), 500
 
-@app.route('/api/subscription/verify-payment', methods=['POST'])
+@bp.route('/api/subscription/verify-payment', methods=['POST'])
 @login_required
 def verify_payment():
     """Verify Razorpay payment and activate subscription"""
@@ -808,6 +1048,7 @@ def verify_payment():
                 }
             }
         )
+        cache.delete('user', current_user.id)
         
         # Save subscription record
         subscriptions_collection.insert_one({
@@ -829,7 +1070,43 @@ def verify_payment():
     except Exception as e:
         return jsonify({'error': f'Payment verification failed: {str(e)}'}), 500
 
-@app.route('/api/health', methods=['GET'])
+@bp.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    """List stored request profiles"""
+    return jsonify({
+        'success': True,
+        'profiles': profiling.list_profiles()
+    })
+
+@bp.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@admin_required
+def get_profile(profile_id):
+    """Get a profile as collapsed stacks, pstats text or an SVG flame graph"""
+    output = request.args.get('format', 'collapsed')
+    
+    if output == 'stats':
+        text = profiling.get_stats_text(profile_id)
+    else:
+        text = profiling.get_collapsed(profile_id)
+    
+    if text is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    if output == 'flamegraph':
+        return current_app.response_class(profiling.render_flamegraph(text, title=profile_id), mimetype='image/svg+xml')
+    return current_app.response_class(text, mimetype='text/plain')
+
+@bp.route('/api/admin/cache/stats', methods=['GET'])
+@admin_required
+def cache_stats():
+    """Cache hit/miss counters for the worker that serves this request"""
+    return jsonify({
+        'success': True,
+        'cache': cache.stats()
+    })
+
+@bp.route('/api/health', methods=['GET'])
 def health_check():
     try:
         # Check if GROQ_API_KEY is set
@@ -842,7 +1119,7 @@ def health_check():
         
         # Check MongoDB connection
         try:
-            mongo_client.server_info()
+            get_mongo_client().server_info()
             db_status = 'connected'
         except:
             db_status = 'disconnected'
@@ -850,7 +1127,8 @@ def health_check():
         return jsonify({
             'status': 'ok',
             'message': 'Server is running',
-            'database': db_status
+            'database': db_status,
+            'startup': get_startup_report()
         })
     except Exception as e:
         return jsonify({
@@ -858,5 +1136,56 @@ def health_check():
             'message': str(e)
         }), 500
 
+def create_app():
+    """Application factory - no network or database connections are opened here"""
+    started = time.perf_counter()
+    
+    app = Flask(__name__)
+    app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-change-this")
+    CORS(app, supports_credentials=True)
+    
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+    
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    
+    login_manager.init_app(app)
+    
+    # OAuth Configuration (Google Login)
+    # Provider metadata is fetched on the first login, not at startup
+    oauth_started = time.perf_counter()
+    from authlib.integrations.flask_client import OAuth
+    oauth = OAuth(app)
+    app.extensions['google_oauth'] = oauth.register(
+        name='google',
+        client_id=os.environ.get("GOOGLE_CLIENT_ID"),
+        client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
+        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+        client_kwargs={'scope': 'openid email profile'},
+    )
+    oauth_seconds = time.perf_counter() - oauth_started
+    
+    app.register_blueprint(bp)
+    # Registered before compression so its after_request hook sees the compressed size
+    traffic.init_traffic(app)
+    init_compression(app)
+    profiling.init_profiling(app)
+    init_retention(app)
+    app.before_request(ensure_startup_report)
+    
+    # Timings of building the app; each worker reports them (with its own pid)
+    # on its first request, since under --preload this runs only in the master
+    app.config['APP_BUILD_REPORT'] = {
+        'pid': os.getpid(),
+        'imports_ms': round(_import_seconds * 1000, 1),
+        'oauth_ms': round(oauth_seconds * 1000, 1),
+        'create_app_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,229 @@
+"""
+Offline bulk report processing
+
+Extracts text from a directory (or manifest) of archived reports across a
+process pool, optionally generates explanations with bounded concurrency,
+and streams one NDJSON result per file with per-file timings. The output
+file doubles as the checkpoint: re-running with --resume skips every file
+whose latest result is ok, and retries the ones that failed (the last
+record for a path wins).
+
+Usage:
+    python batch_process.py reports/ -o results.ndjson
+    python batch_process.py --manifest files.txt -o results.ndjson --explain --resume
+"""
+
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from extraction import allowed_file, extract_pages
+from fun import count_tokens_simple
+from normalize import normalize_text
+
+
+def find_report_files(directory):
+    """Walk a directory and return report files in a stable order"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if allowed_file(name):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def read_manifest(manifest_path):
+    """Read one report path per line, ignoring blank lines, # comments and non-report files"""
+    paths = []
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if allowed_file(os.path.basename(line)):
+                paths.append(line)
+            else:
+                print(f"Skipping {line}: not a PDF or image file", file=sys.stderr)
+    return paths
+
+
+def read_checkpoint(output_path):
+    """Paths whose last result in the output file is ok (errors are retried)"""
+    latest = {}
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                latest[record['path']] = record.get('status')
+            except (ValueError, KeyError):
+                # Partially written last line from an interrupted run
+                continue
+    return {path for path, status in latest.items() if status == 'ok'}
+
+
+def extract_one(path, normalize=True):
+    """Extract one file, turning any failure into an error record (runs in a worker process)"""
+    try:
+        return _extract_one(path, normalize)
+    except Exception as e:
+        # An exception here would propagate through imap_unordered and abort the whole run
+        return {
+            'path': path,
+            'filename': os.path.basename(path),
+            'status': 'error',
+            'error': f"{type(e).__name__}: {str(e)}",
+            'timings': {}
+        }
+
+
+def _extract_one(path, normalize):
+    """Extract (and normalize) text from one file"""
+    started = time.perf_counter()
+    file_ext = path.rsplit('.', 1)[1].lower()
+    pages = extract_pages(path, file_ext)
+    normalization = None
+    if normalize:
+        text, normalization = normalize_text(pages)
+    else:
+        text = "\n".join(pages).strip()
+    extract_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    result = {
+        'path': path,
+        'filename': os.path.basename(path),
+        'status': 'ok',
+        'timings': {'extract_ms': extract_ms}
+    }
+
+    if text.startswith("Error extracting"):
+        result['status'] = 'error'
+        result['error'] = text
+    elif len(text) < 10:
+        result['status'] = 'error'
+        result['error'] = 'Could not extract meaningful text from the file'
+    else:
+        result['text'] = text
+        result['chars'] = len(text)
+        if normalization:
+            result['tokens'] = normalization['tokens_after']
+            result['normalization'] = normalization
+        else:
+            result['tokens'] = count_tokens_simple(text)
+
+    return result
+
+
+def explain_one(result, language):
+    """Add an explanation to an extraction result (runs in a thread)"""
+    from llm import generate_report_explanation
+
+    started = time.perf_counter()
+    result['explanation'] = generate_report_explanation(result['text'], language)
+    result['timings']['explain_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    if result['explanation'] is None:
+        result['status'] = 'explain_error'
+    return result
+
+
+def write_result(out, result, include_text):
+    if not include_text:
+        result.pop('text', None)
+    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    out.flush()
+
+
+def run(paths, output_path, workers, explain=False, language='english',
+        explain_concurrency=4, include_text=True, normalize=True):
+    """Process paths and append NDJSON results to output_path"""
+    counts = {'ok': 0, 'error': 0, 'explain_error': 0}
+    started = time.perf_counter()
+
+    with open(output_path, 'a', encoding='utf-8') as out, \
+            multiprocessing.Pool(processes=workers, maxtasksperchild=200) as pool, \
+            ThreadPoolExecutor(max_workers=explain_concurrency) as explainer:
+        pending = set()
+
+        def finish(result):
+            counts[result['status']] += 1
+            write_result(out, result, include_text)
+
+        for result in pool.imap_unordered(partial(extract_one, normalize=normalize), paths, chunksize=4):
+            if not explain or result['status'] != 'ok':
+                finish(result)
+                continue
+
+            # Bound the number of in-flight LLM calls
+            while len(pending) >= explain_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future.result())
+
+            pending.add(explainer.submit(explain_one, result, language))
+
+        for future in pending:
+            finish(future.result())
+
+    elapsed = time.perf_counter() - started
+    return counts, elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-process archived medical reports into NDJSON")
+    parser.add_argument('directory', nargs='?', help="directory to walk for PDF/image reports")
+    parser.add_argument('--manifest', help="file with one report path per line")
+    parser.add_argument('-o', '--output', required=True, help="NDJSON output file (also the checkpoint)")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="extraction processes")
+    parser.add_argument('--explain', action='store_true', help="also generate an explanation per report")
+    parser.add_argument('--language', default='english', choices=['english', 'hindi', 'gujarati'])
+    parser.add_argument('--explain-concurrency', type=int, default=4, help="max concurrent LLM calls")
+    parser.add_argument('--resume', action='store_true', help="skip files already processed ok in the output file")
+    parser.add_argument('--no-text', action='store_true', help="don't write extracted text to the output")
+    parser.add_argument('--raw', action='store_true', help="skip header/footer and boilerplate normalization")
+    args = parser.parse_args(argv)
+
+    if bool(args.directory) == bool(args.manifest):
+        parser.error("give either a directory or --manifest")
+
+    load_dotenv()
+
+    paths = read_manifest(args.manifest) if args.manifest else find_report_files(args.directory)
+
+    if args.resume:
+        done = read_checkpoint(args.output)
+        paths = [p for p in paths if p not in done]
+        print(f"Resuming: {len(done)} already processed", file=sys.stderr)
+
+    print(f"Processing {len(paths)} files with {args.workers} workers...", file=sys.stderr)
+
+    counts, elapsed = run(
+        paths,
+        args.output,
+        workers=args.workers,
+        explain=args.explain,
+        language=args.language,
+        explain_concurrency=args.explain_concurrency,
+        include_text=not args.no_text,
+        normalize=not args.raw
+    )
+
+    rate = len(paths) / elapsed if elapsed else 0
+    print(
+        f"Done in {elapsed:.1f}s ({rate:.1f} files/s): "
+        f"{counts['ok']} ok, {counts['error']} extraction errors, {counts['explain_error']} explanation errors",
+        file=sys.stderr
+    )
+    return 0 if counts['error'] == 0 and counts['explain_error'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
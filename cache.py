@@ -0,0 +1,244 @@
+"""
+Cache shared by all gunicorn workers
+
+Backends:
+    sqlite - a local SQLite file (default), shared by every worker on the
+             host, survives restarts, LRU-evicted above CACHE_MAX_ENTRIES
+    redis  - a network cache for multi-host deployments (needs `redis`)
+    none   - caching disabled
+
+Entries live in namespaces, each with its own TTL (NAMESPACE_TTLS). Values
+must be JSON-serializable. Cache errors are logged and treated as misses, so
+the cache can never take a request down.
+"""
+
+from collections import Counter
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite")
+CACHE_PATH = os.environ.get("CACHE_PATH", os.path.join(tempfile.gettempdir(), "medical_report_cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Seconds to keep entries, per namespace
+NAMESPACE_TTLS = {
+    'user': 60,
+    'token_count': 24 * 3600
+}
+
+_MISSING = object()
+
+
+class CacheBackend:
+    """Interface for cache backends - keys are already namespaced strings"""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    def get(self, key):
+        return _MISSING
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+class SQLiteCache(CacheBackend):
+    """Disk-backed cache in one SQLite file, shared across processes"""
+
+    # Run LRU eviction once every this many writes
+    EVICT_EVERY = 100
+
+    # A hit refreshes accessed_at only if it is older than this, so most reads
+    # never take SQLite's write lock (LRU order is kept to this granularity)
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _conn(self):
+        # One connection per thread and process (connections must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires_at, accessed_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < now:
+            # Expired rows are overwritten by the next set() or dropped by evict()
+            return _MISSING
+        if now - row[2] > self.TOUCH_INTERVAL:
+            conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now)
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict(now)
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def evict(self, now=None):
+        """Drop expired entries, then the least recently used ones above max_entries"""
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (now or time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+
+class RedisCache(CacheBackend):
+    """Network cache - Redis handles TTL and eviction (configure maxmemory-policy)"""
+
+    def __init__(self, url):
+        import redis
+        self.url = url
+        self._redis = redis
+        self._client = None
+        self._client_pid = None
+
+    def _conn(self):
+        if self._client is None or self._client_pid != os.getpid():
+            self._client = self._redis.Redis.from_url(self.url, socket_timeout=0.5)
+            self._client_pid = os.getpid()
+        return self._client
+
+    def get(self, key):
+        value = self._conn().get(key)
+        return _MISSING if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self._conn().setex(key, int(ttl), json.dumps(value))
+
+    def delete(self, key):
+        self._conn().delete(key)
+
+
+def create_backend(name=CACHE_BACKEND):
+    if name == 'sqlite':
+        return SQLiteCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+    if name == 'redis':
+        return RedisCache(REDIS_URL)
+    return NullCache()
+
+
+class Cache:
+    """Namespaced cache with per-namespace TTLs and hit/miss counters"""
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.errors = Counter()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    try:
+                        self._backend = create_backend()
+                    except Exception as e:
+                        print(f"Cache backend '{CACHE_BACKEND}' unavailable, caching disabled: {str(e)}")
+                        self._backend = NullCache()
+        return self._backend
+
+    def get(self, namespace, key, default=None):
+        try:
+            value = self.backend.get(f"{namespace}:{key}")
+        except Exception as e:
+            print(f"Cache get error ({namespace}): {str(e)}")
+            self.errors[namespace] += 1
+            value = _MISSING
+
+        if value is _MISSING:
+            self.misses[namespace] += 1
+            return default
+        self.hits[namespace] += 1
+        return value
+
+    def set(self, namespace, key, value):
+        try:
+            self.backend.set(f"{namespace}:{key}", value, NAMESPACE_TTLS[namespace])
+        except Exception as e:
+            print(f"Cache set error ({namespace}): {str(e)}")
+            self.errors[namespace] += 1
+
+    def delete(self, namespace, key):
+        try:
+            self.backend.delete(f"{namespace}:{key}")
+        except Exception as e:
+            print(f"Cache delete error ({namespace}): {str(e)}")
+            self.errors[namespace] += 1
+
+    def get_or_set(self, namespace, key, compute):
+        """Return the cached value, or compute, store and return it"""
+        value = self.get(namespace, key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            if value is not None:
+                self.set(namespace, key, value)
+        return value
+
+    def stats(self):
+        """Hit/miss counters for this worker process"""
+        namespaces = set(self.hits) | set(self.misses) | set(self.errors)
+        return {
+            'backend': type(self.backend).__name__,
+            'pid': os.getpid(),
+            'namespaces': {
+                ns: {
+                    'hits': self.hits[ns],
+                    'misses': self.misses[ns],
+                    'errors': self.errors[ns],
+                    'hit_rate': round(self.hits[ns] / (self.hits[ns] + self.misses[ns]), 3) if (self.hits[ns] + self.misses[ns]) else None
+                }
+                for ns in sorted(namespaces)
+            }
+        }
+
+
+cache = Cache()
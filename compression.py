@@ -0,0 +1,93 @@
+"""
+Response compression and conditional GETs
+
+Responses above COMPRESSION_MIN_BYTES are compressed with brotli (if the
+`brotli` package is installed and the client accepts it) or gzip. Views
+decorated with @conditional get an ETag, honour If-None-Match /
+If-Modified-Since, and answer 304 when nothing changed.
+"""
+
+from functools import wraps
+import gzip
+import os
+
+from flask import request, make_response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+COMPRESSION_LEVEL = 6
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript'}
+
+
+def conditional(view):
+    """
+    Add an ETag to a GET view and return 304 if the client's copy is current
+
+    A view can also set response.last_modified before returning.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if request.method != 'GET' or response.status_code != 200:
+            return response
+
+        # Clients must revalidate, but may reuse their copy when we say 304
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
+
+    return wrapper
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """after_request hook - compress large text responses"""
+    if (response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=5)
+    else:
+        compressed = gzip.compress(data, compresslevel=COMPRESSION_LEVEL)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # The compressed body is a different byte representation of the same resource
+    etag, is_weak = response.get_etag()
+    if etag and not is_weak:
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
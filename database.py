@@ -0,0 +1,61 @@
+"""
+MongoDB connection for the app
+
+The client is created lazily in the process that first uses it, so a
+gunicorn master started with --preload never holds a connection pool that
+forked workers would share. Each worker gets its own pool on first access.
+"""
+
+import os
+
+from pymongo import MongoClient
+
+DATABASE_NAME = "medical_db"
+
+# Connection pool settings (per worker process)
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 20))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+
+_client = None
+_client_pid = None
+
+
+def get_mongo_client():
+    """Get the MongoClient for the current process, creating it after fork"""
+    global _client, _client_pid
+
+    if _client is None or _client_pid != os.getpid():
+        _client = MongoClient(
+            os.getenv("MONGO_URI"),
+            serverSelectionTimeoutMS=10000,
+            connectTimeoutMS=10000,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            connect=False
+        )
+        _client_pid = os.getpid()
+
+    return _client
+
+
+def get_db():
+    """Get the application database for the current process"""
+    return get_mongo_client()[DATABASE_NAME]
+
+
+class LazyCollection:
+    """Collection handle that resolves against the current process's client"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_db()[self.name], attr)
+
+
+users_collection = LazyCollection("users")
+chats_collection = LazyCollection("chats")
+reports_collection = LazyCollection("reports")
+subscriptions_collection = LazyCollection("subscriptions")
+chat_summaries_collection = LazyCollection("chat_summaries")
+idempotency_collection = LazyCollection("idempotency_keys")
@@ -0,0 +1,187 @@
+"""
+Streaming export of a user's data (chats, reports, subscriptions)
+
+Everything is read with batched Mongo cursors and written out record by
+record from generators, so memory stays constant no matter how much
+history a user has. Used by /api/user/export and as an admin CLI.
+
+Usage:
+    python export.py --email user@example.com -o export.ndjson
+    python export.py --email user@example.com --format zip -o export.zip
+"""
+
+import argparse
+import json
+import sys
+import zipfile
+
+from dotenv import load_dotenv
+
+EXPORT_BATCH_SIZE = 500
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def iter_profile(user):
+    yield {
+        'type': 'user',
+        'email': user['email'],
+        'name': user.get('name', ''),
+        'subscription_plan': user.get('subscription_plan', 'free'),
+        'subscription_expires': _iso(user.get('subscription_expires')),
+        'created_at': _iso(user.get('created_at'))
+    }
+
+
+def iter_chat_messages(user_id, batch_size=EXPORT_BATCH_SIZE):
+    from database import chats_collection
+    from retention import NOT_DELETED
+
+    cursor = chats_collection.find(
+        {'user_id': user_id, **NOT_DELETED},
+        {'_id': 0, 'chat_id': 1, 'role': 1, 'content': 1, 'timestamp': 1, 'report_id': 1}
+    ).sort([('chat_id', 1), ('timestamp', 1)]).batch_size(batch_size)
+
+    for msg in cursor:
+        yield {
+            'type': 'chat_message',
+            'chat_id': msg['chat_id'],
+            'role': msg['role'],
+            'content': msg['content'],
+            'timestamp': _iso(msg.get('timestamp')),
+            'report_id': msg.get('report_id')
+        }
+
+
+def iter_reports(user_id, batch_size=EXPORT_BATCH_SIZE):
+    from database import reports_collection
+    from retention import NOT_DELETED
+
+    cursor = reports_collection.find(
+        {'user_id': user_id, **NOT_DELETED},
+        {'filename': 1, 'extracted_text': 1, 'uploaded_at': 1}
+    ).sort('uploaded_at', 1).batch_size(batch_size)
+
+    for report in cursor:
+        yield {
+            'type': 'report',
+            'report_id': str(report['_id']),
+            'filename': report.get('filename'),
+            'extracted_text': report.get('extracted_text', ''),
+            'uploaded_at': _iso(report.get('uploaded_at'))
+        }
+
+
+def iter_subscriptions(user_id, batch_size=EXPORT_BATCH_SIZE):
+    from database import subscriptions_collection
+
+    cursor = subscriptions_collection.find(
+        {'user_id': user_id},
+        {'_id': 0, 'plan': 1, 'payment_id': 1, 'order_id': 1, 'amount': 1, 'activated_at': 1, 'expires_at': 1}
+    ).sort('activated_at', 1).batch_size(batch_size)
+
+    for sub in cursor:
+        yield {
+            'type': 'subscription',
+            'plan': sub.get('plan'),
+            'payment_id': sub.get('payment_id'),
+            'order_id': sub.get('order_id'),
+            'amount': sub.get('amount'),
+            'activated_at': _iso(sub.get('activated_at')),
+            'expires_at': _iso(sub.get('expires_at'))
+        }
+
+
+def _line(record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def generate_ndjson(user):
+    """Yield the whole export as NDJSON bytes, one record per line"""
+    user_id = str(user['_id'])
+    for records in (iter_profile(user), iter_chat_messages(user_id), iter_reports(user_id), iter_subscriptions(user_id)):
+        for record in records:
+            yield _line(record)
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def generate_zip(user):
+    """Yield a ZIP (profile.json + one NDJSON file per collection) as it is built"""
+    user_id = str(user['_id'])
+    sink = _ChunkSink()
+
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('profile.json', json.dumps(next(iter_profile(user)), ensure_ascii=False, indent=2))
+        yield sink.drain()
+
+        entries = (
+            ('chats.ndjson', iter_chat_messages(user_id)),
+            ('reports.ndjson', iter_reports(user_id)),
+            ('subscriptions.ndjson', iter_subscriptions(user_id))
+        )
+        for name, records in entries:
+            with archive.open(name, mode='w', force_zip64=True) as entry:
+                for record in records:
+                    entry.write(_line(record))
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+
+    yield sink.drain()
+
+
+EXPORT_FORMATS = {
+    'ndjson': (generate_ndjson, 'application/x-ndjson', 'ndjson'),
+    'zip': (generate_zip, 'application/zip', 'zip')
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export all data for one user")
+    parser.add_argument('--email', required=True, help="user's email address")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='ndjson')
+    parser.add_argument('-o', '--output', help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    from database import users_collection
+
+    user = users_collection.find_one({'email': args.email})
+    if not user:
+        print(f"User not found: {args.email}", file=sys.stderr)
+        return 1
+
+    generate = EXPORT_FORMATS[args.format][0]
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for chunk in generate(user):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""
+Text extraction from uploaded reports
+
+PyPDF2, Pillow and pytesseract are imported on first use instead of at
+module load, so workers that never handle an upload don't pay for them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import os
+import warnings
+import zipfile
+
+ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff'}
+
+
+# Limits for multi-file / ZIP uploads
+MAX_BATCH_FILES = 20
+MAX_ZIP_UNCOMPRESSED_BYTES = 64 * 1024 * 1024
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", 4))
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def extract_pages(file_path, file_ext, max_pages=None):
+    """
+    Extract text per page based on file type (each frame of an image is a page)
+
+    Goes through iter_pages(), so scanned PDF pages are OCRed and every entry
+    point gets the same text as the streaming upload. Errors come back as a
+    single page holding the error message.
+    """
+    try:
+        return list(iter_pages(file_path, file_ext, max_pages))
+    except Exception as e:
+        if file_ext == 'pdf':
+            return [f"Error extracting PDF: {str(e)}"]
+        return [f"Error extracting from image: {str(e)}"]
+
+
+def count_pages(file_path, file_ext):
+    """Number of pages in a PDF, or frames in an image (multi-page TIFF)"""
+    if file_ext == 'pdf':
+        import PyPDF2
+        with open(file_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
+
+    from PIL import Image
+    with Image.open(file_path) as image:
+        return getattr(image, 'n_frames', 1)
+
+
+def iter_pages(file_path, file_ext, max_pages=None):
+    """
+    Yield the text of each page as soon as it is extracted
+
+    PDF pages without a text layer (scans) are OCRed from their embedded
+    images; every frame of a multi-page image is OCRed separately. A PDF
+    page that can't be read comes back as ''. Stops after max_pages pages,
+    if given.
+    """
+    from PIL import Image, ImageSequence
+    import pytesseract
+
+    if file_ext == 'pdf':
+        import io
+        import PyPDF2
+
+        with open(file_path, 'rb') as file:
+            for number, page in enumerate(islice(PyPDF2.PdfReader(file).pages, max_pages), start=1):
+                try:
+                    text = (page.extract_text() or "").strip()
+                    if not text:
+                        texts = []
+                        for embedded in page.images:
+                            with Image.open(io.BytesIO(embedded.data)) as image:
+                                texts.append(pytesseract.image_to_string(image).strip())
+                        text = "\n".join(t for t in texts if t)
+                except pytesseract.TesseractNotFoundError:
+                    raise
+                except Exception as e:
+                    # One undecodable page (e.g. a JBIG2 scan PyPDF2 returns as raw bytes)
+                    # shouldn't cost the rest of the file
+                    print(f"Could not extract page {number} of {os.path.basename(file_path)}: {str(e)}")
+                    text = ""
+                yield text
+        return
+
+    with Image.open(file_path) as image:
+        for frame in islice(ImageSequence.Iterator(image), max_pages):
+            yield pytesseract.image_to_string(frame).strip()
+
+
+def _pdf_page_pixels(page):
+    """Largest embedded image on a PDF page, read from the image dictionaries without decoding"""
+    largest = 0
+    try:
+        xobjects = page['/Resources'].get_object().get('/XObject')
+        if xobjects is None:
+            return 0
+        for ref in xobjects.get_object().values():
+            xobject = ref.get_object()
+            if xobject.get('/Subtype') == '/Image':
+                largest = max(largest, int(xobject.get('/Width', 0)) * int(xobject.get('/Height', 0)))
+    except (KeyError, AttributeError, TypeError, ValueError):
+        pass
+    return largest
+
+
+def _inspect_pdf(file_path, max_pages):
+    import PyPDF2
+
+    try:
+        with open(file_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            if reader.is_encrypted and not reader.decrypt(''):
+                raise ValueError('The PDF is password-protected')
+            total_pages = len(reader.pages)
+            max_pixels = max((_pdf_page_pixels(page) for page in islice(reader.pages, max_pages)), default=0)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f'The file is not a readable PDF ({str(e)})')
+    return total_pages, max_pixels
+
+
+def _inspect_image(file_path, max_pages):
+    from PIL import Image
+
+    try:
+        # Treat Pillow's decompression bomb warning as an error, not just a log line
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            with Image.open(file_path) as image:
+                total_pages = getattr(image, 'n_frames', 1)
+                max_pixels = 0
+                for index in range(min(total_pages, max_pages or total_pages)):
+                    image.seek(index)
+                    max_pixels = max(max_pixels, image.size[0] * image.size[1])
+
+            # verify() checks the file structure without decoding the pixels
+            with Image.open(file_path) as image:
+                image.verify()
+    except (Image.DecompressionBombWarning, Image.DecompressionBombError):
+        raise ValueError('The image is too large to process')
+    except Exception as e:
+        raise ValueError(f'The file is not a readable image ({str(e)})')
+    return total_pages, max_pixels
+
+
+def preflight(file_path, file_ext, max_pages=None, max_pixels=None):
+    """
+    Cheap check of an upload before any text is extracted
+
+    Reads only the PDF structure or the image header, so a 300-page PDF or a
+    12000x9000 image is caught before it costs any OCR time. Only the first
+    max_pages pages are checked against max_pixels and should be extracted.
+
+    Returns:
+        dict: total_pages, processed_pages, truncated and max_pixels
+
+    Raises:
+        ValueError: if the file can't be decoded or a page image is over max_pixels
+    """
+    if file_ext == 'pdf':
+        total_pages, pixels = _inspect_pdf(file_path, max_pages)
+    else:
+        total_pages, pixels = _inspect_image(file_path, max_pages)
+
+    if total_pages == 0:
+        raise ValueError('The file has no pages')
+
+    if max_pixels and pixels > max_pixels:
+        raise ValueError(
+            f'Image resolution is too high ({pixels / 1e6:.0f} megapixels, your plan allows '
+            f'{max_pixels / 1e6:.0f}). Please upload a smaller scan.'
+        )
+
+    processed_pages = min(total_pages, max_pages) if max_pages else total_pages
+    return {
+        'total_pages': total_pages,
+        'processed_pages': processed_pages,
+        'truncated': processed_pages < total_pages,
+        'max_pixels': pixels
+    }
+
+
+def expand_zip(zip_path, dest_dir):
+    """
+    Extract report files from a ZIP into dest_dir
+
+    Only allowed report types are extracted, directory structure is
+    flattened, and the archive is rejected before extraction if it holds too
+    many files or too much uncompressed data.
+
+    Returns:
+        list: (original filename, extracted path) pairs
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        members = [m for m in archive.infolist() if not m.is_dir() and allowed_file(m.filename)]
+
+        if len(members) > MAX_BATCH_FILES:
+            raise ValueError(f'ZIP contains more than {MAX_BATCH_FILES} report files')
+        if sum(m.file_size for m in members) > MAX_ZIP_UNCOMPRESSED_BYTES:
+            raise ValueError('ZIP contents are too large')
+
+        extracted = []
+        for index, member in enumerate(members):
+            filename = os.path.basename(member.filename)
+            file_ext = filename.rsplit('.', 1)[1].lower()
+            path = os.path.join(dest_dir, f"zip_{index}.{file_ext}")
+            with archive.open(member) as src, open(path, 'wb') as dst:
+                dst.write(src.read())
+            extracted.append((filename, path))
+
+    return extracted
+
+
+def extract_pages_concurrently(paths, max_workers=EXTRACTION_WORKERS, page_limits=None):
+    """
+    Extract pages from several files at once
+
+    OCR runs in a tesseract subprocess, so threads overlap well here.
+    page_limits optionally caps the pages extracted from each path.
+
+    Returns:
+        list: list of page texts per path, in the same order as paths
+    """
+    def extract(path, max_pages):
+        return extract_pages(path, path.rsplit('.', 1)[1].lower(), max_pages)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+        return list(executor.map(extract, paths, page_limits or [None] * len(paths)))
+
+
+def merge_report_texts(named_texts):
+    """Combine (filename, text) pairs into one report document"""
+    sections = []
+    for filename, text in named_texts:
+        sections.append(f"===== File: {filename} =====\n{text}")
+    return "\n\n".join(sections)
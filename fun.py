@@ -2,8 +2,23 @@
 Token counting utility for Groq API
 """
 
+import hashlib
+
 import tiktoken
 
+from cache import cache
+
+# Only texts at least this long (e.g. report content) go through the shared cache
+TOKEN_CACHE_MIN_CHARS = 2000
+
+def _count_cached(encoding, text):
+    """Token count for one string, cached across workers for long texts"""
+    if len(text) < TOKEN_CACHE_MIN_CHARS:
+        return len(encoding.encode(text))
+    
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return cache.get_or_set('token_count', key, lambda: len(encoding.encode(text)))
+
 def count_tokens(messages):
     """
     Count tokens in messages using tiktoken
@@ -24,7 +39,7 @@ def count_tokens(messages):
             num_tokens += 4
             
             for key, value in message.items():
-                num_tokens += len(encoding.encode(str(value)))
+                num_tokens += _count_cached(encoding, str(value))
                 
         num_tokens += 2  # Every reply is primed with <im_start>assistant
         
@@ -52,7 +67,7 @@ def count_tokens_simple(text):
     """
     try:
         encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
+        return _count_cached(encoding, text)
     except Exception as e:
         # Fallback: rough estimate
         return len(text) // 4
@@ -0,0 +1,195 @@
+"""
+Idempotency keys and in-flight request coalescing
+
+Clients send an `Idempotency-Key` header with each /api/chat or
+/api/analyze* submission. The first request with a key runs normally;
+duplicates that arrive while it is still running wait for its result, and
+duplicates that arrive after it finished get the stored response replayed
+for IDEMPOTENCY_TTL_SECONDS. For NDJSON streams the stored result is the
+final 'done' event, replayed as plain JSON.
+
+Within a worker, duplicates wait on a threading.Event. Across workers the
+`idempotency_keys` collection is the single-flight table: its unique _id
+decides which request runs, and other workers poll it for the result.
+"""
+
+from datetime import datetime, timedelta
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+from flask import request, jsonify, make_response
+from flask_login import current_user
+from pymongo.errors import DuplicateKeyError
+
+from database import idempotency_collection
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# How long completed responses are replayed
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 24 * 3600))
+
+# An in-flight record older than this is treated as abandoned (crashed worker)
+IN_FLIGHT_TIMEOUT_SECONDS = 300
+
+POLL_INTERVAL_SECONDS = 0.25
+
+_local_flights = {}
+_local_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+def _claim(key):
+    """Try to become the request that runs for this key (across workers)"""
+    now = datetime.utcnow()
+    record = {
+        '_id': key,
+        'state': 'in_flight',
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=IN_FLIGHT_TIMEOUT_SECONDS)
+    }
+    try:
+        idempotency_collection.insert_one(record)
+        return True
+    except DuplicateKeyError:
+        # Take over an abandoned in-flight record or an expired result; the TTL
+        # index only removes them eventually, so don't rely on it for expiry
+        taken = idempotency_collection.find_one_and_update(
+            {'_id': key, 'expires_at': {'$lt': now}},
+            {'$set': record}
+        )
+        return taken is not None
+
+
+def _wait_for_result(key):
+    """Poll the shared table until another worker finishes this key"""
+    deadline = time.monotonic() + IN_FLIGHT_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        record = idempotency_collection.find_one({'_id': key})
+        if record is None:
+            # The first request failed and released the key
+            return None
+        if record['state'] == 'completed':
+            if record['expires_at'] < datetime.utcnow():
+                # Expired but not yet removed by the TTL index - same as missing
+                return None
+            return record['body'], record['status']
+        time.sleep(POLL_INTERVAL_SECONDS)
+    return None
+
+
+def _store(key, body, status):
+    if status >= 500:
+        # Don't replay server errors - let the client retry for real
+        idempotency_collection.delete_one({'_id': key})
+        return
+
+    idempotency_collection.update_one(
+        {'_id': key},
+        {'$set': {
+            'state': 'completed',
+            'body': body,
+            'status': status,
+            'expires_at': datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+        }}
+    )
+
+
+def _replay(result):
+    body, status = result
+    response = make_response(jsonify(body), status)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _record_stream(key, chunks):
+    """Pass an NDJSON stream through and store its final 'done' event for the key"""
+    done = None
+    try:
+        for chunk in chunks:
+            text = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+            for line in text.splitlines():
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(event, dict) and event.get('type') == 'done':
+                    done = event
+            yield chunk
+    finally:
+        # Stream failed or the client went away before the end - let a retry run for real
+        if done is None:
+            idempotency_collection.delete_one({'_id': key})
+        else:
+            _store(key, done, 200)
+
+
+def idempotent(view):
+    """
+    Make a JSON (or NDJSON stream) view idempotent per user + endpoint + Idempotency-Key
+
+    Requests without the header run unchanged.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not client_key:
+            return view(*args, **kwargs)
+
+        key = f"{current_user.id}:{request.endpoint}:{client_key[:128]}"
+
+        # Coalesce duplicates inside this worker
+        with _local_lock:
+            flight = _local_flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _local_flights[key] = _Flight()
+
+        if not is_leader:
+            flight.done.wait(IN_FLIGHT_TIMEOUT_SECONDS)
+            # A streamed leader returns before its body is sent - wait on the shared table
+            result = flight.result or _wait_for_result(key)
+            if result is not None:
+                return _replay(result)
+            return jsonify({'error': 'Duplicate request is still in progress'}), 409
+
+        try:
+            if not _claim(key):
+                # Another worker owns this key - replay its result
+                result = _wait_for_result(key)
+                if result is None:
+                    return jsonify({'error': 'Duplicate request is still in progress'}), 409
+                flight.result = result
+                return _replay(result)
+
+            response = make_response(view(*args, **kwargs))
+            if response.is_streamed and response.mimetype == 'application/x-ndjson':
+                response.response = _record_stream(key, response.response)
+                return response
+
+            body = response.get_json(silent=True)
+            if body is None:
+                idempotency_collection.delete_one({'_id': key})
+                return response
+
+            if response.status_code < 500:
+                # Server errors aren't replayed - duplicates get a 409 and retry for real
+                flight.result = (body, response.status_code)
+            _store(key, body, response.status_code)
+            return response
+        except Exception:
+            idempotency_collection.delete_one({'_id': key})
+            raise
+        finally:
+            with _local_lock:
+                _local_flights.pop(key, None)
+            flight.done.set()
+
+    return wrapper
@@ -8,13 +8,17 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 
+from database import DATABASE_NAME
+from retention import SOFT_DELETE_GRACE_DAYS
+
 # Load environment variables
 load_dotenv()
 
 # MongoDB connection
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
 client = MongoClient(MONGO_URI)
-db = client['medical_assistant']
+# Same database the app reads and writes, so the TTL indexes apply to it
+db = client[DATABASE_NAME]
 
 print("🗄️  Initializing Medical Assistant Database...")
 print("=" * 50)
@@ -24,6 +28,8 @@ users_collection = db['users']
 chats_collection = db['chats']
 reports_collection = db['reports']
 subscriptions_collection = db['subscriptions']
+chat_summaries_collection = db['chat_summaries']
+idempotency_collection = db['idempotency_keys']
 
 # Create indexes for better performance
 print("\n📊 Creating indexes...")
@@ -38,12 +44,20 @@ users_collection.create_index([("last_active", DESCENDING)])
 print("   - Creating chats indexes...")
 chats_collection.create_index([("user_id", ASCENDING), ("chat_id", ASCENDING)])
 chats_collection.create_index([("timestamp", DESCENDING)])
+chats_collection.create_index([("report_id", ASCENDING)], sparse=True)
 chats_collection.create_index([("chat_id", ASCENDING)])
+# Export streams a user's messages sorted by chat, then time
+chats_collection.create_index([("user_id", ASCENDING), ("chat_id", ASCENDING), ("timestamp", ASCENDING)])
+# Soft-deleted chats are removed after the grace period (TTL index)
+chats_collection.create_index([("deleted_at", ASCENDING)], expireAfterSeconds=SOFT_DELETE_GRACE_DAYS * 86400)
 
 # Reports collection indexes
 print("   - Creating reports indexes...")
 reports_collection.create_index([("user_id", ASCENDING)])
 reports_collection.create_index([("uploaded_at", DESCENDING)])
+# Export streams a user's reports sorted by upload time
+reports_collection.create_index([("user_id", ASCENDING), ("uploaded_at", ASCENDING)])
+reports_collection.create_index([("deleted_at", ASCENDING)], expireAfterSeconds=SOFT_DELETE_GRACE_DAYS * 86400)
 
 # Subscriptions collection indexes
 print("   - Creating subscriptions indexes...")
@@ -51,6 +65,14 @@ subscriptions_collection.create_index([("user_id", ASCENDING)])
 subscriptions_collection.create_index([("payment_id", ASCENDING)], unique=True)
 subscriptions_collection.create_index([("expires_at", DESCENDING)])
 
+# Chat summaries collection indexes
+print("   - Creating chat summaries indexes...")
+chat_summaries_collection.create_index([("user_id", ASCENDING), ("chat_id", ASCENDING)], unique=True)
+
+# Idempotency keys expire automatically (TTL index)
+print("   - Creating idempotency keys indexes...")
+idempotency_collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+
 print("\n✅ Indexes created successfully!")
 
 # Display collection stats
@@ -0,0 +1,326 @@
+"""
+Model routing for Groq chat completions
+
+Short, no-report and follow-up questions go to a fast small model, full
+report explanations go to the large model, and every request type has its
+own output token cap. If the chosen model times out, the request is retried
+once on the other model.
+
+The Groq SDK is imported and the client created on first use in each worker
+process, after gunicorn has forked.
+"""
+
+import os
+import time
+
+from fun import count_tokens, count_tokens_simple
+from traffic import is_recording, record_llm_call
+
+# Model table - names can be overridden per deployment
+MODELS = {
+    'fast': {
+        'name': os.environ.get("GROQ_FAST_MODEL", "llama-3.1-8b-instant"),
+        'context_window': 131072,
+        'max_output_tokens': 8192,
+        'timeout': float(os.environ.get("GROQ_FAST_TIMEOUT", 20))
+    },
+    'large': {
+        'name': os.environ.get("GROQ_LARGE_MODEL", "llama-3.3-70b-versatile"),
+        'context_window': 131072,
+        'max_output_tokens': 32768,
+        'timeout': float(os.environ.get("GROQ_LARGE_TIMEOUT", 60))
+    }
+}
+
+# Request types - which model to use first, which to fall back to, and the output cap
+REQUEST_TYPES = {
+    'report_explanation': {
+        'model': 'large',
+        'fallback': 'fast',
+        'max_tokens': 4096
+    },
+    'report_question': {
+        'model': 'large',
+        'fallback': 'fast',
+        'max_tokens': 2048
+    },
+    'simple_question': {
+        'model': 'fast',
+        'fallback': 'large',
+        'max_tokens': 1024
+    },
+    'chat_summary': {
+        'model': 'fast',
+        'fallback': 'large',
+        'max_tokens': 1024
+    }
+}
+
+# HTTP connection pool size for the Groq client (per worker process)
+GROQ_MAX_CONNECTIONS = int(os.environ.get("GROQ_MAX_CONNECTIONS", 10))
+
+SAFETY_BUFFER = 1000
+MIN_OUTPUT_TOKENS = 100
+
+# Questions at or below this many tokens count as "short"
+SIMPLE_QUESTION_MAX_TOKENS = int(os.environ.get("SIMPLE_QUESTION_MAX_TOKENS", 40))
+
+
+_groq_client = None
+_groq_client_pid = None
+
+
+def get_groq_client():
+    """Get the Groq client for the current process, creating it after fork"""
+    global _groq_client, _groq_client_pid
+
+    if _groq_client is None or _groq_client_pid != os.getpid():
+        # Replay/load tests: no network, latencies sampled from a traffic recording
+        stub = os.environ.get("GROQ_STUB")
+        if stub:
+            from traffic import StubGroqClient
+            _groq_client = StubGroqClient(stub, float(os.environ.get("GROQ_STUB_SPEEDUP", 1)))
+            _groq_client_pid = os.getpid()
+            return _groq_client
+
+        import httpx
+        from groq import Groq
+
+        api_key = os.environ.get("GROQ_API_KEY")
+        if not api_key:
+            raise ValueError("GROQ_API_KEY environment variable not set")
+
+        # No SDK retries - a timeout must reach create_completion() at once so
+        # it can fall back to the other model
+        _groq_client = Groq(
+            api_key=api_key,
+            max_retries=0,
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=GROQ_MAX_CONNECTIONS,
+                    max_keepalive_connections=GROQ_MAX_CONNECTIONS
+                )
+            )
+        )
+        _groq_client_pid = os.getpid()
+
+    return _groq_client
+
+
+def classify_chat_request(user_message, report_text='', history=None):
+    """
+    Pick the request type for a chat message
+
+    Short questions without a report, and short follow-ups in a chat that
+    already has an assistant answer, are routed to the fast model. Everything
+    else that involves a report goes to the large model.
+    """
+    if count_tokens_simple(user_message) > SIMPLE_QUESTION_MAX_TOKENS:
+        return 'report_question' if report_text else 'simple_question'
+
+    if not report_text:
+        return 'simple_question'
+
+    is_follow_up = any(msg['role'] == 'assistant' for msg in (history or []))
+    return 'simple_question' if is_follow_up else 'report_question'
+
+
+def max_output_tokens(model_key, request_type, prompt_tokens):
+    """Output token budget for a model/request type given the prompt size"""
+    model = MODELS[model_key]
+    return min(
+        REQUEST_TYPES[request_type]['max_tokens'],
+        model['max_output_tokens'],
+        model['context_window'] - prompt_tokens - SAFETY_BUFFER
+    )
+
+
+def create_completion(client, messages, request_type, temperature=0.3, top_p=0.9):
+    """
+    Run a chat completion on the routed model, falling back on timeout
+
+    Returns:
+        tuple: (response text, model name), or (None, None) if the prompt
+        does not fit in any model's context window
+    """
+    from groq import APITimeoutError
+
+    route = REQUEST_TYPES[request_type]
+    prompt_tokens = count_tokens(messages)
+    last_error = None
+
+    for model_key in (route['model'], route['fallback']):
+        max_tokens = max_output_tokens(model_key, request_type, prompt_tokens)
+        if max_tokens < MIN_OUTPUT_TOKENS:
+            continue
+
+        model = MODELS[model_key]
+        started = time.perf_counter()
+        try:
+            chat_completion = client.chat.completions.create(
+                messages=messages,
+                model=model['name'],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                timeout=model['timeout']
+            )
+        except APITimeoutError as e:
+            record_llm_call(request_type, model['name'], prompt_tokens, 0,
+                            (time.perf_counter() - started) * 1000, outcome='timeout')
+            print(f"Model {model['name']} timed out for {request_type}, trying fallback")
+            last_error = e
+            continue
+
+        usage = getattr(chat_completion, 'usage', None)
+        record_llm_call(request_type, model['name'], prompt_tokens, getattr(usage, 'completion_tokens', None),
+                        (time.perf_counter() - started) * 1000)
+        return chat_completion.choices[0].message.content, model['name']
+
+    if last_error:
+        raise last_error
+    return None, None
+
+
+def stream_completion(client, messages, request_type, temperature=0.3, top_p=0.9):
+    """
+    Like create_completion(), but yields the response text as it arrives
+
+    A timeout falls back to the other model only if nothing has been
+    yielded yet. Yields nothing if the prompt fits no model.
+    """
+    from groq import APITimeoutError
+
+    route = REQUEST_TYPES[request_type]
+    prompt_tokens = count_tokens(messages)
+    last_error = None
+
+    for model_key in (route['model'], route['fallback']):
+        max_tokens = max_output_tokens(model_key, request_type, prompt_tokens)
+        if max_tokens < MIN_OUTPUT_TOKENS:
+            continue
+
+        model = MODELS[model_key]
+        started = False
+        call_started = time.perf_counter()
+        first_token_ms = None
+        parts = [] if is_recording() else None
+        try:
+            stream = client.chat.completions.create(
+                messages=messages,
+                model=model['name'],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=top_p,
+                timeout=model['timeout'],
+                stream=True
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    if not started:
+                        first_token_ms = (time.perf_counter() - call_started) * 1000
+                    started = True
+                    if parts is not None:
+                        parts.append(delta)
+                    yield delta
+            if parts is not None:
+                record_llm_call(request_type, model['name'], prompt_tokens, count_tokens_simple(''.join(parts)),
+                                (time.perf_counter() - call_started) * 1000, first_token_ms)
+            return
+        except APITimeoutError as e:
+            record_llm_call(request_type, model['name'], prompt_tokens, 0,
+                            (time.perf_counter() - call_started) * 1000, first_token_ms, outcome='timeout')
+            if started:
+                raise
+            print(f"Model {model['name']} timed out for {request_type}, trying fallback")
+            last_error = e
+
+    if last_error:
+        raise last_error
+
+
+# Language-specific prompts for the automatic report explanation
+REPORT_EXPLANATION_PROMPTS = {
+    'hindi': """कृपया इस मेडिकल रिपोर्ट का पूर्ण विश्लेषण हिंदी में प्रदान करें। निम्नलिखित बिंदुओं को कवर करें:
+
+1. **रिपोर्ट का सारांश**: यह रिपोर्ट किस बारे में है?
+2. **महत्वपूर्ण निष्कर्ष**: रिपोर्ट में क्या पाया गया?
+3. **असामान्य मान**: कौन से टेस्ट परिणाम सामान्य सीमा से बाहर हैं?
+4. **सामान्य भाषा में स्पष्टीकरण**: मेडिकल शब्दों को सरल हिंदी में समझाएं
+5. **सुझाव**: क्या कोई सावधानियां या अगले कदम हैं?
+
+कृपया सरल और समझने योग्य हिंदी में जवाब दें। हमेशा डॉक्टर से परामर्श की सलाह दें।""",
+
+    'english': """Please provide a complete analysis of this medical report in English. Cover the following points:
+
+1. **Report Summary**: What is this report about?
+2. **Key Findings**: What was found in the report?
+3. **Abnormal Values**: Which test results are outside normal range?
+4. **Plain Language Explanation**: Explain medical terms in simple English
+5. **Recommendations**: Any precautions or next steps?
+
+Please respond in simple and understandable English. Always recommend consulting a doctor.""",
+
+    'gujarati': """કૃપા કરીને આ મેડિકલ રિપોર્ટનું સંપૂર્ણ વિશ્લેષણ ગુજરાતીમાં પ્રદાન કરો. નીચેના મુદ્દાઓને આવરી લો:
+
+1. **રિપોર્ટનો સારાંશ**: આ રિપોર્ટ શેના વિશે છે?
+2. **મહત્વના તારણો**: રિપોર્ટમાં શું મળ્યું?
+3. **અસામાન્ય મૂલ્યો**: કયા ટેસ્ટ પરિણામો સામાન્ય મર્યાદાની બહાર છે?
+4. **સરળ ભાષામાં સમજૂતી**: મેડિકલ શબ્દોને સરળ ગુજરાતીમાં સમજાવો
+5. **ભલામણો**: કોઈ સાવધાનીઓ અથવા આગળના પગલાં?
+
+કૃપા કરીને સરળ અને સમજી શકાય તેવા ગુજરાતીમાં જવાબ આપો. હંમેશા ડૉક્ટર સાથે પરામર્શ કરવાની સલાહ આપો."""
+}
+
+REPORT_EXPLANATION_SYSTEM_PROMPT = """You are a helpful medical assistant AI. Provide clear, comprehensive medical report analysis.
+Be empathetic, explain medical terms simply, and always recommend consulting a doctor for specific medical advice."""
+
+
+def build_report_explanation_messages(report_text, language='english'):
+    """Messages for the automatic report explanation in the selected language"""
+    language_prompt = REPORT_EXPLANATION_PROMPTS.get(language, REPORT_EXPLANATION_PROMPTS['english'])
+    return [
+        {
+            "role": "system",
+            "content": REPORT_EXPLANATION_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": f"{language_prompt}\n\nMedical Report Content:\n\n{report_text}"
+        }
+    ]
+
+
+RECONCILIATION_PROMPT = """You have already explained the first pages of this medical report (your explanation is below).
+The remaining pages have now been extracted. Add only what these pages contribute or change: new findings,
+abnormal values and recommendations. Do not repeat what is already covered, and write in the same language
+as your explanation."""
+
+
+def build_reconciliation_messages(explanation, remaining_text):
+    """Messages for the follow-up pass over pages that arrived after the explanation started"""
+    return [
+        {
+            "role": "system",
+            "content": REPORT_EXPLANATION_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": f"{RECONCILIATION_PROMPT}\n\nYour Explanation So Far:\n\n{explanation}\n\nRemaining Report Pages:\n\n{remaining_text}"
+        }
+    ]
+
+def generate_report_explanation(report_text, language='english'):
+    """Generate automatic report explanation in selected language"""
+    try:
+        client = get_groq_client()
+        messages = build_report_explanation_messages(report_text, language)
+        
+        # Full report explanation always goes to the large model
+        explanation, _ = create_completion(client, messages, 'report_explanation')
+        return explanation
+        
+    except Exception as e:
+        print(f"Error generating explanation: {str(e)}")
+        return None
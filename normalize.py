@@ -0,0 +1,179 @@
+"""
+Extracted-text normalization
+
+Runs once when a report is uploaded, before the text is stored and sent to
+the LLM:
+
+1. Header/footer lines repeated in the same top/bottom position on most
+   pages are kept only on the first page they appear on
+2. Boilerplate lines (page numbers, disclaimers, "end of report", ...)
+   matching BOILERPLATE_PATTERNS are dropped
+3. Common OCR confusions inside numbers are fixed (1O.5 -> 10.5, l2 -> 12)
+4. Control characters, separator-only lines and whitespace runs are removed
+
+Extra boilerplate patterns (one regex per line) can be added with
+NORMALIZE_PATTERNS_FILE.
+"""
+
+import math
+import os
+import re
+import unicodedata
+
+from fun import count_tokens_simple
+
+# Lines matching any of these (case-insensitive, whole line) are dropped
+BOILERPLATE_PATTERNS = [
+    r'page\s*(no\.?\s*)?:?\s*\d+\s*((of|/)\s*\d+)?',
+    r'\**\s*end\s+of\s+(the\s+)?report\s*\**',
+    r'.*computer[\s-]*generated\s+report.*',
+    r'.*does\s+not\s+require\s+(any\s+)?signature.*',
+    r'.*not\s+(valid|for)\s+(for\s+)?medico[\s-]*legal.*',
+    r'.*results?\s+(are\s+)?to\s+be\s+(clinically\s+)?correlated.*',
+    r'.*please\s+correlate\s+clinically.*',
+    r'printed\s+(on|at|by)\s*:?.*',
+    r'scan\s+(the\s+)?qr\s+code.*'
+]
+
+NORMALIZE_PATTERNS_FILE = os.environ.get("NORMALIZE_PATTERNS_FILE")
+
+# Only this many lines at the top and bottom of a page count as header/footer
+HEADER_FOOTER_LINES = 6
+
+# A header/footer line must repeat in the same position on at least this fraction
+# of the pages, and on at least MIN_REPEAT_PAGES pages, to be removed
+REPEAT_PAGE_FRACTION = 0.5
+MIN_REPEAT_PAGES = 3
+
+# Zero-width space, word joiner, BOM and the replacement character (ZWJ/ZWNJ are
+# kept - Indic scripts use them)
+_ZERO_WIDTH = re.compile('[\u200b\u2060\ufeff\ufffd]')
+_SPACES = re.compile(r'[ \t ]+')
+_BLANK_LINES = re.compile(r'\n{3,}')
+_RESULT_VALUE = re.compile(
+    r'(negative|positive|nil|absent|present|normal|abnormal|trace|(non[\s-]*)?reactive|(not\s+)?(detected|seen))'
+    r'\s*(\(.*\))?',
+    re.IGNORECASE
+)
+# O misread as 0, only with a digit on at least one side (1O.5, 10.O, 5Omg) - never
+# touches dotted abbreviations like S.O.S or A.O. Sharma
+# A bare value, range and/or unit line (12.5, 4.0 - 11.0 x10^3/uL, mg/dL)
+_UNIT = r'%|x?\s*10\^\d+(?:\s*/\s*[a-zµμ\d^.]+)*|[a-zµμ]+\d*(?:\s*/\s*[a-zµμ\d^.]+)+|mg|g|ml|l|iu|u|fl|pg|mmol|meq|cells|ratio'
+_NUMBER = r'[<>≤≥]?\s*[-+]?\d+(?:[.,]\d+)?'
+_MEASUREMENT = re.compile(rf'{_NUMBER}(?:\s*(?:-|–|to)\s*{_NUMBER})?\s*(?:{_UNIT})?|{_UNIT}', re.IGNORECASE)
+_OCR_O_IN_NUMBER = re.compile(
+    r'(?<=\d)[Oo](?=[\d.,])|(?<=\d[.,])[Oo](?![a-z])|(?<=\d)[Oo](?=\s*(?:%|mg|g/|mmol|iu|u/))',
+    re.IGNORECASE
+)
+# l/I misread as 1, only inside a token that is otherwise all digits (l2.5, 1l0) - never
+# touches words like IgG or Il-6, or '|' column separators in OCR'd tables
+_OCR_L_NUMBER_TOKEN = re.compile(r'(?<![\w.,])(?=[\dlI.,]*\d)[\dlI]+(?:[.,][\dlI]+)*(?!\w|[.,]\w)')
+
+
+def _load_patterns():
+    patterns = list(BOILERPLATE_PATTERNS)
+    if NORMALIZE_PATTERNS_FILE and os.path.exists(NORMALIZE_PATTERNS_FILE):
+        with open(NORMALIZE_PATTERNS_FILE, encoding='utf-8') as f:
+            patterns.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    return [re.compile(rf'^\s*(?:{p})\s*$', re.IGNORECASE) for p in patterns]
+
+
+_boilerplate = _load_patterns()
+
+
+def _clean_line(line):
+    line = _ZERO_WIDTH.sub('', line)
+    line = ''.join(ch for ch in line if ch == '\t' or unicodedata.category(ch) != 'Cc')
+    line = _OCR_O_IN_NUMBER.sub('0', line)
+    line = _OCR_L_NUMBER_TOKEN.sub(lambda m: m.group().replace('l', '1').replace('I', '1'), line)
+    return _SPACES.sub(' ', line).strip()
+
+
+def _is_noise(line):
+    # Separator rows like "-----" or "|||||" carry no information
+    return not any(ch.isalnum() for ch in line)
+
+
+def _edge_positions(lines):
+    """Header/footer position(s) of each non-empty line in a page's edge zones"""
+    content = [i for i, line in enumerate(lines) if line]
+    positions = {}
+    for rank, i in enumerate(content[:HEADER_FOOTER_LINES]):
+        positions.setdefault(i, set()).add(('top', rank))
+    for rank, i in enumerate(reversed(content[-HEADER_FOOTER_LINES:])):
+        positions.setdefault(i, set()).add(('bottom', rank))
+    return positions
+
+
+def _is_result_value(line):
+    # Values, units and Negative/Nil-style results repeat across pages by nature -
+    # short letterhead lines (CITY LAB, Dr X) are still deduped
+    return _MEASUREMENT.fullmatch(line) is not None or _RESULT_VALUE.fullmatch(line) is not None
+
+
+def normalize_pages(pages):
+    """
+    Normalize extracted pages
+
+    Returns:
+        tuple: (list of normalized page texts, stats dict)
+    """
+    cleaned = [[_clean_line(line) for line in (page or '').splitlines()] for page in pages]
+
+    # Count on how many pages each line appears in each header/footer position
+    page_counts = {}
+    for lines in cleaned:
+        keys = {(lines[i].lower(), position) for i, positions in _edge_positions(lines).items() for position in positions}
+        for key in keys:
+            page_counts[key] = page_counts.get(key, 0) + 1
+    min_pages = max(MIN_REPEAT_PAGES, math.ceil(len(pages) * REPEAT_PAGE_FRACTION))
+    repeated = {key for key, count in page_counts.items() if count >= min_pages and not _is_result_value(key[0])}
+
+    seen_repeated = set()
+    removed = {'repeated': 0, 'boilerplate': 0, 'noise': 0}
+    result = []
+    for lines in cleaned:
+        edges = _edge_positions(lines)
+        kept = []
+        for i, line in enumerate(lines):
+            if not line:
+                kept.append(line)
+                continue
+
+            key = line.lower()
+            if any((key, position) in repeated for position in edges.get(i, ())):
+                if key in seen_repeated:
+                    removed['repeated'] += 1
+                    continue
+                seen_repeated.add(key)
+
+            if any(p.match(line) for p in _boilerplate):
+                removed['boilerplate'] += 1
+            elif _is_noise(line):
+                removed['noise'] += 1
+            else:
+                kept.append(line)
+
+        result.append(_BLANK_LINES.sub('\n\n', '\n'.join(kept)).strip())
+
+    before = "\n".join(pages)
+    after = "\n".join(result)
+    tokens_before = count_tokens_simple(before)
+    tokens_after = count_tokens_simple(after)
+
+    stats = {
+        'pages': len(pages),
+        'chars_before': len(before),
+        'chars_after': len(after),
+        'tokens_before': tokens_before,
+        'tokens_after': tokens_after,
+        'tokens_saved_pct': round((tokens_before - tokens_after) / tokens_before * 100, 1) if tokens_before else 0.0,
+        'lines_removed': removed
+    }
+    return result, stats
+
+
+def normalize_text(pages):
+    """Normalize pages and join them into one report text"""
+    normalized, stats = normalize_pages(pages)
+    return "\n\n".join(page for page in normalized if page).strip(), stats
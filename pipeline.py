@@ -0,0 +1,163 @@
+"""
+Pipelined report analysis
+
+Pages are extracted one at a time in a background thread and surfaced to
+the client as soon as each one is ready. The explanation starts once
+PIPELINE_START_FRACTION of the pages or PIPELINE_START_TOKENS of text is
+available, so OCR of the later pages overlaps with LLM time. Pages that
+arrive after the explanation started are covered by a short reconciliation
+pass when extraction finishes.
+"""
+
+import contextvars
+import math
+import os
+import queue
+import threading
+
+from extraction import count_pages, iter_pages
+from fun import count_tokens_simple
+from llm import get_groq_client, stream_completion, build_report_explanation_messages, build_reconciliation_messages
+from normalize import normalize_pages
+from profiling import profile_current_thread
+
+# Start the explanation once this fraction of the pages has been extracted...
+PIPELINE_START_FRACTION = float(os.environ.get("PIPELINE_START_FRACTION", 0.3))
+
+# ...or once the extracted text reaches this many tokens, whichever comes first
+PIPELINE_START_TOKENS = int(os.environ.get("PIPELINE_START_TOKENS", 3000))
+
+
+def _extract(file_path, file_ext, max_pages, events, stop):
+    profile_current_thread()
+    try:
+        for number, text in enumerate(iter_pages(file_path, file_ext, max_pages), start=1):
+            if stop.is_set():
+                return
+            events.put(('page', number, text))
+    except Exception as e:
+        events.put(('extract_error', str(e)))
+        return
+    events.put(('extract_done',))
+
+
+def _explain(phase, messages, events, stop):
+    profile_current_thread()
+    try:
+        for delta in stream_completion(get_groq_client(), messages, 'report_explanation'):
+            if stop.is_set():
+                return
+            events.put(('delta', phase, delta))
+    except Exception as e:
+        print(f"Error generating {phase}: {str(e)}")
+    events.put(('explain_done', phase))
+
+
+def _join(pages):
+    return "\n\n".join(page for page in pages if page).strip()
+
+
+def run_pipeline(file_path, file_ext, language='english', max_pages=None):
+    """
+    Analyze one report, yielding progress events as they happen
+
+    Only the first max_pages pages are extracted, if given. Events (dicts
+    with a 'type'): start, page, explanation_started, explanation_delta,
+    reconciliation_started, error. The last event is 'result' with the
+    normalized report text, the full explanation and the normalization stats.
+    """
+    page_count = count_pages(file_path, file_ext)
+    if max_pages:
+        page_count = min(page_count, max_pages)
+    yield {'type': 'start', 'page_count': page_count}
+
+    events = queue.Queue()
+    stop = threading.Event()
+    # Worker threads run in a copy of this context so the request's profiler can sample them
+    threading.Thread(
+        target=contextvars.copy_context().run, args=(_extract, file_path, file_ext, max_pages, events, stop),
+        name='pipeline-extract', daemon=True
+    ).start()
+
+    def start(phase, messages):
+        # ...and so the request's traffic trace sees the Groq calls
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(_explain, phase, messages, events, stop),
+            name=f'pipeline-{phase}', daemon=True
+        ).start()
+
+    start_pages = max(1, math.ceil(page_count * PIPELINE_START_FRACTION))
+    pages = []
+    text_tokens = 0
+    explained_pages = 0
+    explanation_pages = 0
+    running = None
+    extraction_done = False
+    parts = {'explanation': [], 'reconciliation': []}
+
+    try:
+        while True:
+            if running is None and not explained_pages:
+                ready = text_tokens and (len(pages) >= start_pages or text_tokens >= PIPELINE_START_TOKENS)
+                if ready or extraction_done:
+                    normalized, _ = normalize_pages(pages)
+                    if len(_join(normalized)) < 10:
+                        yield {'type': 'error', 'error': 'Could not extract meaningful text from the file. Please ensure the file is clear and readable.'}
+                        return
+
+                    explained_pages = explanation_pages = len(pages)
+                    running = 'explanation'
+                    yield {'type': 'explanation_started', 'pages_used': explained_pages}
+                    start(running, build_report_explanation_messages(_join(normalized), language))
+
+            elif running is None and extraction_done:
+                if explained_pages == len(pages) or not parts['explanation']:
+                    break
+
+                # Normalize all pages together so headers seen earlier are still dropped
+                normalized, _ = normalize_pages(pages)
+                remaining = _join(normalized[explained_pages:])
+                explained_pages = len(pages)
+                if remaining:
+                    running = 'reconciliation'
+                    yield {'type': 'reconciliation_started', 'pages_used': explained_pages - explanation_pages}
+                    start(running, build_reconciliation_messages(''.join(parts['explanation']), remaining))
+                continue
+
+            event = events.get()
+            kind = event[0]
+
+            if kind == 'page':
+                _, number, text = event
+                pages.append(text)
+                if text:
+                    text_tokens += count_tokens_simple(text)
+                yield {'type': 'page', 'page': number, 'page_count': page_count, 'text': text}
+            elif kind == 'extract_done':
+                extraction_done = True
+            elif kind == 'extract_error':
+                yield {'type': 'error', 'error': f"Error extracting text: {event[1]}"}
+                return
+            elif kind == 'delta':
+                _, phase, delta = event
+                parts[phase].append(delta)
+                yield {'type': 'explanation_delta', 'phase': phase, 'text': delta}
+            elif kind == 'explain_done':
+                running = None
+    finally:
+        # Client went away or we are done - stop the worker threads early
+        stop.set()
+
+    extracted_text, normalization = normalize_pages(pages)
+    explanation = ''.join(parts['explanation']).strip()
+    reconciliation = ''.join(parts['reconciliation']).strip()
+    if explanation and reconciliation:
+        explanation = f"{explanation}\n\n{reconciliation}"
+
+    yield {
+        'type': 'result',
+        'extracted_text': _join(extracted_text),
+        'explanation': explanation or None,
+        'normalization': normalization,
+        'explanation_pages': explanation_pages
+    }
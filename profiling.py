@@ -0,0 +1,342 @@
+"""
+On-demand per-request profiling
+
+A request is profiled when it carries `X-Profile: <PROFILE_TOKEN>`, or
+randomly at PROFILE_SAMPLE_RATE. By default a background thread samples the
+request thread's stack every PROFILE_INTERVAL_MS, plus any worker threads
+that call profile_current_thread() (the upload pipeline does), and writes
+collapsed stacks (one `frame;frame;frame count` line per stack);
+`X-Profile-Mode: cprofile` records a cProfile .prof file of the request
+thread instead. Artifacts go to PROFILE_DIR. Streamed responses are profiled
+until their body has been sent.
+
+Usage:
+    python profiling.py list
+    python profiling.py show <profile_id>
+    python profiling.py flamegraph <profile_id> -o flame.svg
+"""
+
+import argparse
+from collections import Counter
+import contextvars
+import cProfile
+from datetime import datetime
+import hmac
+import html
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+from flask import g, request
+
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+PROFILE_EXTENSIONS = ('.collapsed', '.prof')
+
+# Sampler of the request being profiled, visible to threads started in a copy of its context
+_sampler = contextvars.ContextVar('profile_sampler', default=None)
+
+
+class StackSampler:
+    """Samples the Python stacks of a set of threads from a background thread"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_ids = {thread_id}
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add_thread(self, thread_id):
+        self.thread_ids.add(thread_id)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in list(self.thread_ids):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _should_profile():
+    header = request.headers.get('X-Profile', '')
+    if PROFILE_TOKEN and header and hmac.compare_digest(header, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_profile():
+    """before_request hook"""
+    if not _should_profile():
+        return
+
+    g.profile_started = time.perf_counter()
+    if request.headers.get('X-Profile-Mode') == 'cprofile':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    else:
+        g.profiler = StackSampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000)
+        g.profiler.start()
+        _sampler.set(g.profiler)
+
+
+def profile_current_thread():
+    """Include the calling thread in the request's stack samples (no-op when not profiling)"""
+    sampler = _sampler.get()
+    if sampler is not None:
+        sampler.add_thread(threading.get_ident())
+
+
+def _stop(profiler):
+    _sampler.set(None)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    else:
+        profiler.stop()
+
+
+def _save(profiler, profile_id):
+    _stop(profiler)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if isinstance(profiler, cProfile.Profile):
+        profiler.dump_stats(os.path.join(PROFILE_DIR, profile_id + '.prof'))
+    else:
+        with open(os.path.join(PROFILE_DIR, profile_id + '.collapsed'), 'w', encoding='utf-8') as f:
+            f.write(profiler.collapsed())
+
+
+def finish_profile(response):
+    """after_request hook - stop the profiler and save the artifact"""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+
+    started = g.pop('profile_started')
+    endpoint = (request.endpoint or 'unknown').replace('.', '-')
+    profile_id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}_{endpoint}"
+
+    if response.is_streamed:
+        # The body (and the work behind it) runs after this hook - save on close
+        profile_id += '_streamed'
+        response.call_on_close(lambda: _save(profiler, profile_id))
+    else:
+        profile_id += f"_{int((time.perf_counter() - started) * 1000)}ms"
+        _save(profiler, profile_id)
+
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def discard_profile(exc=None):
+    """teardown_request hook - stop a profiler left running by an unhandled error"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        _stop(profiler)
+
+
+def init_profiling(app):
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(discard_profile)
+
+
+def list_profiles():
+    """Stored profiles, newest first"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        profile_id, ext = os.path.splitext(name)
+        if ext in PROFILE_EXTENSIONS:
+            profiles.append({
+                'id': profile_id,
+                'type': 'cprofile' if ext == '.prof' else 'sampled',
+                'size': os.path.getsize(os.path.join(PROFILE_DIR, name))
+            })
+    return sorted(profiles, key=lambda p: p['id'], reverse=True)
+
+
+def _profile_path(profile_id):
+    # Profile ids are generated by us - never let one escape PROFILE_DIR
+    if os.path.basename(profile_id) != profile_id:
+        return None
+    for ext in PROFILE_EXTENSIONS:
+        path = os.path.join(PROFILE_DIR, profile_id + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _pstats_collapsed(path):
+    """
+    Approximate collapsed stacks from a cProfile file
+
+    cProfile only records caller -> callee edges, so each function's own
+    time is attributed to the chain of its heaviest callers.
+    """
+    stats = pstats.Stats(path).stats
+
+    def label(func):
+        filename, line, name = func
+        return f"{name} ({os.path.basename(filename)}:{line})"
+
+    lines = []
+    for func, (_, _, tottime, _, callers) in stats.items():
+        samples = int(tottime * 1000)
+        if samples <= 0:
+            continue
+
+        chain = [func]
+        seen = {func}
+        current = callers
+        while current:
+            parent = max(current, key=lambda c: current[c][3])
+            if parent in seen:
+                break
+            chain.append(parent)
+            seen.add(parent)
+            current = stats.get(parent, (0, 0, 0, 0, {}))[4]
+
+        lines.append(f"{';'.join(label(f) for f in reversed(chain))} {samples}\n")
+
+    return ''.join(lines)
+
+
+def get_collapsed(profile_id):
+    """Collapsed stacks for a stored profile, or None if it doesn't exist"""
+    path = _profile_path(profile_id)
+    if path is None:
+        return None
+    if path.endswith('.prof'):
+        return _pstats_collapsed(path)
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def get_stats_text(profile_id, limit=40):
+    """pstats summary (cumulative time) for a cProfile profile"""
+    path = _profile_path(profile_id)
+    if path is None or not path.endswith('.prof'):
+        return None
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def render_flamegraph(collapsed, title='Flame Graph', width=1200, row_height=16):
+    """Render collapsed stacks as a standalone SVG flame graph"""
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(' ')
+        if not stack or not count.isdigit():
+            continue
+        count = int(count)
+        root['value'] += count
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'name': name, 'value': 0, 'children': {}})
+            node['value'] += count
+
+    rects = []
+    max_depth = [0]
+
+    def layout(node, x, depth):
+        max_depth[0] = max(max_depth[0], depth)
+        w = node['value'] / root['value'] * width if root['value'] else 0
+        rects.append((x, depth, w, node))
+        child_x = x
+        for child in sorted(node['children'].values(), key=lambda c: c['name']):
+            layout(child, child_x, depth + 1)
+            child_x += child['value'] / root['value'] * width
+
+    layout(root, 0, 0)
+
+    height = (max_depth[0] + 1) * row_height + 30
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">',
+        f'<text x="4" y="16" font-size="14">{html.escape(title)}</text>'
+    ]
+    for x, depth, w, node in rects:
+        if w < 0.5:
+            continue
+        y = height - (depth + 1) * row_height
+        hue = 20 + (hash(node['name']) % 40)
+        pct = node['value'] / root['value'] * 100 if root['value'] else 0
+        label = html.escape(node['name'])
+        parts.append(
+            f'<g><title>{label} ({node["value"]} samples, {pct:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+        )
+        max_chars = int(w / 7)
+        if max_chars >= 3:
+            text = node['name'] if len(node['name']) <= max_chars else node['name'][:max_chars - 2] + '..'
+            parts.append(f'<text x="{x + 2:.1f}" y="{y + row_height - 4}">{html.escape(text)}</text>')
+        parts.append('</g>')
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect stored request profiles")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="list stored profiles")
+    show = sub.add_parser('show', help="print collapsed stacks (or pstats summary with --stats)")
+    show.add_argument('profile_id')
+    show.add_argument('--stats', action='store_true', help="pstats summary for cProfile profiles")
+    flame = sub.add_parser('flamegraph', help="render an SVG flame graph")
+    flame.add_argument('profile_id')
+    flame.add_argument('-o', '--output', required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for profile in list_profiles():
+            print(f"{profile['id']}  {profile['type']}  {profile['size']} bytes")
+        return 0
+
+    if args.command == 'show' and args.stats:
+        text = get_stats_text(args.profile_id)
+    else:
+        text = get_collapsed(args.profile_id)
+
+    if text is None:
+        print(f"Profile not found: {args.profile_id}", file=sys.stderr)
+        return 1
+
+    if args.command == 'show':
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(render_flamegraph(text, title=args.profile_id))
+        print(f"Flame graph written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
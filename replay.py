@@ -0,0 +1,302 @@
+"""
+Replay recorded traffic against a local instance for capacity planning
+
+Reads a TRAFFIC_RECORD_PATH recording, rebuilds each request with synthetic
+content of the recorded size (filler chat messages, text PDFs with the
+recorded page and token counts) and sends it on the recorded schedule,
+compressed by --speed. Reports throughput and latency percentiles per
+endpoint.
+
+Run the instance with the stub Groq backend so no real LLM calls are made,
+and replay as a test user on the unlimited plan (question limits apply):
+
+    GROQ_STUB=traffic.ndjson GROQ_STUB_SPEEDUP=4 gunicorn -w 4 --preload app:app
+    python replay.py traffic.ndjson --email loadtest@example.com --speed 4
+
+Scanned reports are replayed as text PDFs, so OCR load is not reproduced.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+from traffic import filler_text, read_traces
+
+REPLAYABLE = {
+    ('POST', '/api/chat'),
+    ('POST', '/api/analyze'),
+    ('POST', '/api/analyze/stream'),
+    ('POST', '/api/analyze/batch'),
+    ('GET', '/api/chats'),
+    ('GET', '/api/chat/<chat_id>'),
+    ('GET', '/api/user/info'),
+    ('GET', '/api/subscription/plans'),
+    ('GET', '/api/health'),
+    ('GET', '/')
+}
+
+PDF_LINE_CHARS = 90
+PDF_PAGE_LINES = 60
+
+_local = threading.local()
+
+
+def _pdf_escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def make_pdf(page_texts):
+    """Minimal text-only PDF with one page per string"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    page_ids = []
+    for text in page_texts:
+        lines = []
+        for word in text.split():
+            if lines and len(lines[-1]) + len(word) < PDF_LINE_CHARS:
+                lines[-1] += ' ' + word
+            else:
+                lines.append(word)
+        body = "BT /F1 9 Tf 11 TL 40 800 Td " + ' '.join(
+            f"({_pdf_escape(line)}) '" for line in lines[:PDF_PAGE_LINES]
+        ) + " ET"
+        content = body.encode('latin-1', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects))
+        )
+        page_ids.append(len(objects))
+
+    kids = ' '.join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def synthetic_report(pages, tokens):
+    """PDF bytes with `pages` pages and roughly `tokens` tokens of text"""
+    pages = max(1, pages or 1)
+    per_page = max(20, (tokens or 300) // pages)
+    return make_pdf([filler_text(per_page) for _ in range(pages)])
+
+
+def plan_requests(traces, chat_ids):
+    """Turn replayable traces into (offset seconds, trace, method, path, chat id) tuples"""
+    first_ts = traces[0]['ts']
+    planned = []
+    for trace in traces:
+        key = (trace['method'], trace['endpoint'])
+        if key not in REPLAYABLE:
+            continue
+
+        chat_id = chat_ids.setdefault(trace['chat'], str(uuid.uuid4())) if trace.get('chat') else str(uuid.uuid4())
+        path = trace['endpoint'].replace('<chat_id>', chat_id)
+        planned.append((trace['ts'] - first_ts, trace, trace['method'], path, chat_id))
+    return planned
+
+
+def build_kwargs(trace, chat_id):
+    """Request body for a trace, sized like the recorded one"""
+    endpoint = trace['endpoint']
+    headers = {}
+
+    if endpoint == '/api/chat':
+        headers['Idempotency-Key'] = str(uuid.uuid4())
+        return {'headers': headers, 'json': {
+            'message': filler_text(trace.get('message_tokens') or 20),
+            'report_text': filler_text(trace['report_tokens']) if trace.get('report_tokens') else '',
+            'chat_id': chat_id
+        }}
+
+    if endpoint == '/api/analyze/batch':
+        files_count = max(1, trace.get('files') or len(trace.get('uploads', [])) or 1)
+        pages = max(files_count, trace.get('pages') or files_count)
+        tokens = trace.get('report_tokens') or 300
+        headers['Idempotency-Key'] = str(uuid.uuid4())
+        files = [
+            ('files', (f"report_{i}.pdf", synthetic_report(pages // files_count, tokens // files_count), 'application/pdf'))
+            for i in range(files_count)
+        ]
+        return {'headers': headers, 'files': files, 'data': {'chat_id': chat_id}}
+
+    if endpoint in ('/api/analyze', '/api/analyze/stream'):
+        if endpoint == '/api/analyze':
+            headers['Idempotency-Key'] = str(uuid.uuid4())
+        pdf = synthetic_report(trace.get('pages'), trace.get('report_tokens'))
+        return {'headers': headers, 'files': {'file': ('report.pdf', pdf, 'application/pdf')}, 'data': {'chat_id': chat_id}}
+
+    return {}
+
+
+def _session(cookie):
+    import requests
+
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.cookies.set('session', cookie)
+        _local.session = session
+    return session
+
+
+def send(base_url, cookie, trace, method, path, chat_id, due, started, timeout):
+    """Send one replayed request and time it (runs in a worker thread)"""
+    result = {'endpoint': trace['endpoint'], 'lag_ms': round((time.perf_counter() - started - due) * 1000, 1)}
+    sent = time.perf_counter()
+    try:
+        response = _session(cookie).request(
+            method, base_url + path, timeout=timeout, stream=True, **build_kwargs(trace, chat_id)
+        )
+        result['ttfb_ms'] = (time.perf_counter() - sent) * 1000
+        for _ in response.iter_content(chunk_size=8192):
+            pass
+        result['status'] = response.status_code
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    result['latency_ms'] = (time.perf_counter() - sent) * 1000
+    return result
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarize(results, elapsed):
+    by_endpoint = {}
+    for result in results:
+        by_endpoint.setdefault(result['endpoint'], []).append(result)
+    by_endpoint['all'] = results
+
+    summary = {'requests': len(results), 'elapsed_s': round(elapsed, 2),
+               'throughput_rps': round(len(results) / elapsed, 2) if elapsed else None, 'endpoints': {}}
+    for endpoint, items in by_endpoint.items():
+        latencies = [r['latency_ms'] for r in items]
+        ttfbs = [r['ttfb_ms'] for r in items if 'ttfb_ms' in r]
+        summary['endpoints'][endpoint] = {
+            'count': len(items),
+            'errors': sum(1 for r in items if r['status'] == 'error' or r['status'] >= 500),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'ttfb_p95_ms': round(percentile(ttfbs, 95), 1) if ttfbs else None,
+            'max_lag_ms': max(r['lag_ms'] for r in items)
+        }
+
+    statuses = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+    summary['statuses'] = statuses
+    return summary
+
+
+def print_summary(summary, recorded_s, speed):
+    print(f"Replayed {summary['requests']} requests in {summary['elapsed_s']}s "
+          f"({summary['throughput_rps']} req/s; recorded span {recorded_s:.1f}s at {speed}x)")
+    print(f"{'endpoint':<28} {'count':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'p95 ttfb':>9} {'max lag':>9}")
+    for endpoint, row in summary['endpoints'].items():
+        print(f"{endpoint:<28} {row['count']:>6} {row['errors']:>6} {row['p50_ms']:>9} "
+              f"{row['p95_ms']:>9} {row['p99_ms']:>9} {str(row['ttfb_p95_ms']):>9} {row['max_lag_ms']:>9}")
+    print("Status codes: " + ', '.join(f"{code}: {count}" for code, count in sorted(summary['statuses'].items())))
+
+
+def login_cookie(email):
+    """Signed Flask session cookie for a user, made with the instance's SECRET_KEY"""
+    from flask import Flask
+    from flask.sessions import SecureCookieSessionInterface
+    from database import users_collection
+
+    user = users_collection.find_one({'email': email})
+    if not user:
+        return None
+
+    app = Flask('replay')
+    app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-change-this")
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(user['_id']), '_fresh': True})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded traffic against a local instance")
+    parser.add_argument('traces', help="NDJSON file written with TRAFFIC_RECORD_PATH")
+    parser.add_argument('--email', required=True, help="existing local user to send requests as")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--speed', type=float, default=1.0, help="speed-up factor for the recorded schedule")
+    parser.add_argument('--concurrency', type=int, default=32, help="max requests in flight")
+    parser.add_argument('--limit', type=int, help="replay only the first N requests")
+    parser.add_argument('--timeout', type=float, default=120, help="per-request timeout in seconds")
+    parser.add_argument('--json', dest='json_out', help="also write the summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+
+    traces = read_traces(args.traces)
+    if not traces:
+        print(f"No traces in {args.traces}", file=sys.stderr)
+        return 1
+
+    planned = plan_requests(traces, {})[:args.limit]
+    if not planned:
+        print("No replayable requests in the recording", file=sys.stderr)
+        return 1
+
+    cookie = login_cookie(args.email)
+    if cookie is None:
+        print(f"User not found: {args.email} (log in once on the local instance first)", file=sys.stderr)
+        return 1
+
+    recorded_s = planned[-1][0]
+    print(f"Replaying {len(planned)} of {len(traces)} recorded requests at {args.speed}x...", file=sys.stderr)
+
+    started = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for offset, trace, method, path, chat_id in planned:
+            due = offset / args.speed
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(
+                send, args.base_url.rstrip('/'), cookie, trace, method, path, chat_id, due, started, args.timeout
+            ))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    summary = summarize(results, elapsed)
+    print_summary(summary, recorded_s, args.speed)
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+    return 0 if not any(r['status'] == 'error' for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+Data retention
+
+Chat messages and reports older than their plan's retention period are
+deleted by a background sweeper in bounded batches, and reports no longer
+referenced by any chat message are cleaned up. Deleted chats are only
+soft-deleted in the request (`deleted_at` is set); a TTL index removes them
+after SOFT_DELETE_GRACE_DAYS (see init_db.py).
+
+Only one worker sweeps at a time - a lease document in the `locks`
+collection is taken before each run.
+
+Usage:
+    python retention.py            # run one sweep now (e.g. from cron)
+"""
+
+from datetime import datetime, timedelta
+import os
+import socket
+import sys
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from database import get_db, users_collection, chats_collection, reports_collection
+
+# Days to keep data per collection and plan (None = keep forever)
+RETENTION_POLICIES = {
+    'chats': {
+        'free': 90,
+        'starter': 180,
+        'pro': 365,
+        'unlimited': None
+    },
+    'reports': {
+        'free': 90,
+        'starter': 180,
+        'pro': 365,
+        'unlimited': None
+    }
+}
+
+# Timestamp field used for age per collection
+RETENTION_FIELDS = {
+    'chats': 'timestamp',
+    'reports': 'uploaded_at'
+}
+
+SOFT_DELETE_GRACE_DAYS = int(os.environ.get("SOFT_DELETE_GRACE_DAYS", 7))
+
+# Reports are inserted just before their chat message - don't treat brand new ones as orphans
+ORPHAN_REPORT_GRACE = timedelta(hours=1)
+
+RETENTION_SWEEP_INTERVAL_SECONDS = int(os.environ.get("RETENTION_SWEEP_INTERVAL_SECONDS", 0))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 500))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.environ.get("RETENTION_BATCH_PAUSE_SECONDS", 0.1))
+
+LOCK_ID = 'retention_sweeper'
+LOCK_LEASE = timedelta(minutes=30)
+
+# Filter that excludes soft-deleted documents
+NOT_DELETED = {'deleted_at': None}
+
+
+def soft_delete_chat(user_id, chat_id):
+    """Mark a chat and the reports uploaded into it as deleted"""
+    from database import chat_summaries_collection
+
+    now = datetime.utcnow()
+    query = {'user_id': user_id, 'chat_id': chat_id, **NOT_DELETED}
+
+    report_ids = chats_collection.distinct('report_id', {**query, 'report_id': {'$exists': True}})
+    chats_collection.update_many(query, {'$set': {'deleted_at': now}})
+
+    if report_ids:
+        from bson.objectid import ObjectId
+        reports_collection.update_many(
+            {'_id': {'$in': [ObjectId(r) for r in report_ids]}, 'user_id': user_id},
+            {'$set': {'deleted_at': now}}
+        )
+
+    chat_summaries_collection.delete_one({'user_id': user_id, 'chat_id': chat_id})
+
+
+def delete_in_batches(collection, query, batch_size=RETENTION_BATCH_SIZE):
+    """Delete matching documents a batch at a time, returning the count"""
+    deleted = 0
+    while True:
+        ids = [doc['_id'] for doc in collection.find(query, {'_id': 1}).limit(batch_size)]
+        if not ids:
+            return deleted
+
+        deleted += collection.delete_many({'_id': {'$in': ids}}).deleted_count
+        if len(ids) < batch_size:
+            return deleted
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+
+def _iter_user_id_batches(plan, batch_size=RETENTION_BATCH_SIZE):
+    query = {'subscription_plan': {'$in': ['free', None]}} if plan == 'free' else {'subscription_plan': plan}
+    batch = []
+    for user in users_collection.find(query, {'_id': 1}).batch_size(batch_size):
+        batch.append(str(user['_id']))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def sweep_expired(now=None):
+    """Delete data older than each plan's retention period"""
+    now = now or datetime.utcnow()
+    collections = {'chats': chats_collection, 'reports': reports_collection}
+    counts = {}
+
+    for name, policy in RETENTION_POLICIES.items():
+        field = RETENTION_FIELDS[name]
+        counts[name] = 0
+        for plan, days in policy.items():
+            if days is None:
+                continue
+            cutoff = now - timedelta(days=days)
+            for user_ids in _iter_user_id_batches(plan):
+                counts[name] += delete_in_batches(
+                    collections[name],
+                    {'user_id': {'$in': user_ids}, field: {'$lt': cutoff}}
+                )
+
+    return counts
+
+
+def sweep_orphaned_reports(now=None, batch_size=RETENTION_BATCH_SIZE):
+    """Delete reports that no chat message references any more"""
+    now = now or datetime.utcnow()
+    deleted = 0
+    last_id = None
+
+    while True:
+        query = {'uploaded_at': {'$lt': now - ORPHAN_REPORT_GRACE}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+
+        ids = [doc['_id'] for doc in reports_collection.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size)]
+        if not ids:
+            return deleted
+        last_id = ids[-1]
+
+        referenced = set(chats_collection.distinct('report_id', {'report_id': {'$in': [str(i) for i in ids]}}))
+        orphans = [i for i in ids if str(i) not in referenced]
+        if orphans:
+            deleted += reports_collection.delete_many({'_id': {'$in': orphans}}).deleted_count
+
+        if len(ids) < batch_size:
+            return deleted
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+
+def _lock_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _acquire_lock():
+    locks = get_db()['locks']
+    now = datetime.utcnow()
+    try:
+        locks.find_one_and_update(
+            {'_id': LOCK_ID, 'expires_at': {'$lt': now}},
+            {'$set': {'expires_at': now + LOCK_LEASE, 'owner': _lock_owner()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Lock exists and hasn't expired - another worker is sweeping
+        return False
+
+
+def _release_lock():
+    get_db()['locks'].update_one(
+        {'_id': LOCK_ID, 'owner': _lock_owner()},
+        {'$set': {'expires_at': datetime.utcnow()}}
+    )
+
+
+def run_sweep():
+    """Run one full retention sweep if no other worker is running one"""
+    if not _acquire_lock():
+        return None
+
+    try:
+        started = time.perf_counter()
+        counts = sweep_expired()
+        counts['orphaned_reports'] = sweep_orphaned_reports()
+        print(f"Retention sweep done in {time.perf_counter() - started:.1f}s: {counts}")
+        return counts
+    finally:
+        _release_lock()
+
+
+def _sweep_loop():
+    while True:
+        try:
+            run_sweep()
+        except Exception as e:
+            print(f"Retention sweep error: {str(e)}")
+        time.sleep(RETENTION_SWEEP_INTERVAL_SECONDS)
+
+
+_sweeper_pid = None
+_sweeper_lock = threading.Lock()
+
+
+def ensure_sweeper_started():
+    """before_request hook - start this worker's sweeper thread after fork"""
+    global _sweeper_pid
+
+    if RETENTION_SWEEP_INTERVAL_SECONDS <= 0 or _sweeper_pid == os.getpid():
+        return
+
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+        threading.Thread(target=_sweep_loop, name='retention-sweeper', daemon=True).start()
+
+
+def init_retention(app):
+    app.before_request(ensure_sweeper_started)
+
+
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    result = run_sweep()
+    if result is None:
+        print("Another retention sweep is already running")
+    sys.exit(0)
@@ -0,0 +1,162 @@
+"""
+Rolling conversation summaries for long chats
+
+Once the messages that are not yet covered by a chat's summary grow past
+SUMMARY_TRIGGER_TOKENS, the older ones are folded into the summary in a
+background thread. chat() then sends summary + recent turns instead of the
+raw history, so prompt size stays roughly constant however long a chat gets.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import threading
+
+from database import chats_collection, chat_summaries_collection
+from fun import count_tokens
+from llm import get_groq_client, create_completion
+from retention import NOT_DELETED
+
+# Unsummarized history above this many tokens triggers a summary update
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", 3000))
+
+# Number of most recent messages always kept verbatim
+KEEP_RECENT_MESSAGES = int(os.environ.get("SUMMARY_KEEP_RECENT_MESSAGES", 6))
+
+# Upper bound on raw messages sent alongside the summary
+MAX_RECENT_MESSAGES = 20
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and a medical assistant.
+Keep every test name, value, unit, medicine, symptom and recommendation that was mentioned, and any
+question that is still open. Write the summary in the same language the user is using. Be concise."""
+
+_executor = None
+_executor_pid = None
+_in_progress = set()
+_in_progress_lock = threading.Lock()
+
+
+def _get_executor():
+    """Background executor for the current process, created after fork"""
+    global _executor, _executor_pid
+
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chat-summary')
+        _executor_pid = os.getpid()
+
+    return _executor
+
+
+def get_chat_summary(user_id, chat_id):
+    """Get the stored summary for a chat, or None"""
+    return chat_summaries_collection.find_one({'user_id': user_id, 'chat_id': chat_id})
+
+
+def get_unsummarized_messages(user_id, chat_id, summary=None):
+    """Get user/assistant messages newer than the chat's summary, oldest first"""
+    query = {
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'role': {'$in': ['user', 'assistant']},
+        **NOT_DELETED
+    }
+    if summary:
+        query['timestamp'] = {'$gt': summary['summarized_until']}
+
+    return list(chats_collection.find(
+        query,
+        {'role': 1, 'content': 1, 'timestamp': 1}
+    ).sort('timestamp', 1))
+
+
+def build_history_messages(user_id, chat_id):
+    """
+    Build the conversation part of the chat prompt
+
+    Returns:
+        list: an optional summary system message followed by recent turns
+    """
+    summary = get_chat_summary(user_id, chat_id)
+    recent = get_unsummarized_messages(user_id, chat_id, summary)
+
+    messages = []
+    if summary:
+        messages.append({
+            'role': 'system',
+            'content': f"Summary of the earlier conversation:\n\n{summary['summary']}"
+        })
+
+    limit = MAX_RECENT_MESSAGES if summary else 10
+    for msg in recent[-limit:]:
+        messages.append({
+            'role': msg['role'],
+            'content': msg['content']
+        })
+
+    return messages
+
+
+def update_chat_summary(user_id, chat_id):
+    """Fold older unsummarized messages into the chat summary if over the threshold"""
+    summary = get_chat_summary(user_id, chat_id)
+    messages = get_unsummarized_messages(user_id, chat_id, summary)
+
+    older = messages[:-KEEP_RECENT_MESSAGES]
+    if not older:
+        return False
+
+    history_tokens = count_tokens([{'role': m['role'], 'content': m['content']} for m in messages])
+    if history_tokens <= SUMMARY_TRIGGER_TOKENS:
+        return False
+
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in older)
+    previous = summary['summary'] if summary else "(none)"
+
+    new_summary, _ = create_completion(
+        get_groq_client(),
+        [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{previous}\n\nNew messages:\n{transcript}"}
+        ],
+        'chat_summary',
+        temperature=0.2
+    )
+    if not new_summary:
+        return False
+
+    # Only move forward - never overwrite a summary that already covers more
+    query = {'user_id': user_id, 'chat_id': chat_id}
+    if summary:
+        query['summarized_until'] = summary['summarized_until']
+
+    chat_summaries_collection.update_one(
+        query,
+        {'$set': {
+            'summary': new_summary,
+            'summarized_until': older[-1]['timestamp'],
+            'summarized_messages': (summary or {}).get('summarized_messages', 0) + len(older),
+            'updated_at': datetime.utcnow()
+        }},
+        upsert=not summary
+    )
+    return True
+
+
+def _run_summary_update(user_id, chat_id):
+    try:
+        update_chat_summary(user_id, chat_id)
+    except Exception as e:
+        print(f"Error updating chat summary: {str(e)}")
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard(chat_id)
+
+
+def schedule_summary_update(user_id, chat_id):
+    """Queue a background summary update for a chat (at most one at a time per chat)"""
+    with _in_progress_lock:
+        if chat_id in _in_progress:
+            return
+        _in_progress.add(chat_id)
+
+    _get_executor().submit(_run_summary_update, user_id, chat_id)
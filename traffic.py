@@ -0,0 +1,209 @@
+"""
+Anonymized traffic recording, and a stub Groq backend to replay it against
+
+With TRAFFIC_RECORD_PATH set, requests (a TRAFFIC_SAMPLE_RATE fraction of
+them) append one NDJSON trace each: route pattern, status, payload sizes,
+timings, report/message token counts and every Groq call the request made
+(request type, model, token counts, latency). Message text, report text,
+file names, emails and ids are never written - chats are only linked by a
+keyed hash, so replay can keep a conversation's turns together.
+
+replay.py reads the traces back and drives a local instance. Start that
+instance with GROQ_STUB=<trace file> and get_groq_client() returns a
+StubGroqClient, which answers with filler text after a latency sampled from
+the recorded calls to the same model (divided by GROQ_STUB_SPEEDUP).
+"""
+
+import contextvars
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from flask import current_app, request
+
+TRAFFIC_RECORD_PATH = os.environ.get("TRAFFIC_RECORD_PATH")
+TRAFFIC_SAMPLE_RATE = float(os.environ.get("TRAFFIC_SAMPLE_RATE", 1))
+
+# Latency used by the stub when there are no recorded calls for a model
+STUB_DEFAULT_CALL = {'latency_ms': 1500.0, 'first_token_ms': 300.0, 'completion_tokens': 400, 'outcome': 'ok'}
+
+_trace = contextvars.ContextVar('traffic_trace', default=None)
+_write_lock = threading.Lock()
+
+
+def is_recording():
+    """True if the current request is being traced"""
+    return _trace.get() is not None
+
+
+def annotate(**fields):
+    """Add sizes/counts to the current request's trace (no-op when not recording)"""
+    trace = _trace.get()
+    if trace is not None:
+        trace.update(fields)
+
+
+def record_llm_call(request_type, model, prompt_tokens, completion_tokens, latency_ms,
+                    first_token_ms=None, outcome='ok'):
+    """Add one Groq call to the current request's trace (no-op when not recording)"""
+    trace = _trace.get()
+    if trace is None:
+        return
+    trace['llm_calls'].append({
+        'request_type': request_type,
+        'model': model,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'latency_ms': round(latency_ms, 1),
+        'first_token_ms': round(first_token_ms, 1) if first_token_ms is not None else None,
+        'outcome': outcome
+    })
+
+
+def _anonymize(value):
+    key = current_app.secret_key.encode('utf-8')
+    return hmac.new(key, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+
+def _upload_sizes():
+    sizes = []
+    for file in request.files.values():
+        file.stream.seek(0, os.SEEK_END)
+        sizes.append({
+            'ext': file.filename.rsplit('.', 1)[-1].lower() if '.' in file.filename else '',
+            'bytes': file.stream.tell()
+        })
+    return sizes
+
+
+def start_trace():
+    if not TRAFFIC_RECORD_PATH or random.random() >= TRAFFIC_SAMPLE_RATE:
+        _trace.set(None)
+        return
+
+    _trace.set({
+        'ts': round(time.time(), 3),
+        'method': request.method,
+        'endpoint': None,
+        'pid': os.getpid(),
+        'request_bytes': request.content_length or 0,
+        'llm_calls': [],
+        '_started': time.perf_counter()
+    })
+
+
+def finish_trace(response):
+    trace = _trace.get()
+    if trace is None:
+        return response
+
+    trace['endpoint'] = request.url_rule.rule if request.url_rule else '<unmatched>'
+    trace['status'] = response.status_code
+    trace['streamed'] = response.is_streamed
+    trace['response_bytes'] = response.calculate_content_length()
+    trace['handler_ms'] = round((time.perf_counter() - trace['_started']) * 1000, 1)
+    if request.files:
+        trace['uploads'] = _upload_sizes()
+
+    chat_id = trace.pop('chat_id', None) or (request.view_args or {}).get('chat_id')
+    if chat_id:
+        trace['chat'] = _anonymize(chat_id)
+
+    # Streamed bodies (and their Groq calls) finish after this hook - write on close
+    response.call_on_close(lambda: write_trace(trace))
+    return response
+
+
+def write_trace(trace):
+    trace['duration_ms'] = round((time.perf_counter() - trace.pop('_started')) * 1000, 1)
+    line = json.dumps(trace, ensure_ascii=False) + "\n"
+    try:
+        with _write_lock, open(TRAFFIC_RECORD_PATH, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError as e:
+        print(f"Traffic recording error: {str(e)}")
+    _trace.set(None)
+
+
+def init_traffic(app):
+    if not TRAFFIC_RECORD_PATH:
+        return
+    app.before_request(start_trace)
+    app.after_request(finish_trace)
+    print(f"Recording traffic to {TRAFFIC_RECORD_PATH} (sample rate {TRAFFIC_SAMPLE_RATE})")
+
+
+def read_traces(path):
+    """Recorded traces in time order, skipping partially written lines"""
+    traces = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                continue
+    return sorted(traces, key=lambda t: t['ts'])
+
+
+_FILLER_WORDS = ("the report shows values within the normal range please consult your doctor "
+                 "for advice on these results and any follow up tests").split()
+
+
+def filler_text(tokens):
+    """Roughly `tokens` tokens of harmless text"""
+    return ' '.join(_FILLER_WORDS[i % len(_FILLER_WORDS)] for i in range(max(1, tokens)))
+
+
+class StubGroqClient:
+    """Stands in for groq.Groq during replay - no network, recorded latencies"""
+
+    def __init__(self, trace_path=None, speedup=1.0):
+        self.speedup = speedup
+        self.calls = {}
+        if trace_path and os.path.exists(trace_path):
+            for trace in read_traces(trace_path):
+                for call in trace.get('llm_calls', []):
+                    self.calls.setdefault(call['model'], []).append(call)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _sample(self, model):
+        calls = self.calls.get(model) or [c for model_calls in self.calls.values() for c in model_calls]
+        return random.choice(calls) if calls else STUB_DEFAULT_CALL
+
+    def _create(self, messages, model, max_tokens=1024, stream=False, **kwargs):
+        call = self._sample(model)
+        latency = call['latency_ms'] / 1000 / self.speedup
+
+        if call.get('outcome') == 'timeout':
+            import httpx
+            from groq import APITimeoutError
+            time.sleep(latency)
+            raise APITimeoutError(request=httpx.Request('POST', 'https://api.groq.com/openai/v1/chat/completions'))
+
+        tokens = min(call.get('completion_tokens') or STUB_DEFAULT_CALL['completion_tokens'], max_tokens)
+        text = filler_text(tokens)
+
+        if not stream:
+            time.sleep(latency)
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+                usage=SimpleNamespace(completion_tokens=tokens)
+            )
+        return self._stream(text, call, latency)
+
+    def _stream(self, text, call, latency):
+        first_token = min((call.get('first_token_ms') or 0) / 1000 / self.speedup, latency)
+        words = text.split(' ')
+        gap = (latency - first_token) / len(words)
+
+        time.sleep(first_token)
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(gap)
+            delta = word if index == 0 else ' ' + word
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])